@@ -791,6 +791,9 @@ def update_meal_plan_endpoint():
         return jsonify({"error": "Missing or invalid input data"}), 400
 
     from services.mealplan_update_dynamic_service import update_meal_plan
-    updated = update_meal_plan(original_plan, logs)
+    try:
+        updated = update_meal_plan(original_plan, logs)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     return jsonify(updated), 200
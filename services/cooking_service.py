@@ -1,38 +1,33 @@
 from utils.supabase_client import supabase
 from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
 
 
 # ---------------------------------------------------------
 #   Helper: Apply NULL, NOT NULL, or normal filter
 # ---------------------------------------------------------
-def apply_null_filter(query, column, value):
-    if value is None:
-        return query
-
-    if value == "null":
-        return query.is_(column, None)
+_FILTER_DISPATCH = {
+    None: lambda query, column, value: query,
+    "null": lambda query, column, value: query.is_(column, None),
+    "not_null": lambda query, column, value: query.not_.is_(column, None),
+}
 
-    if value == "not_null":
-        return query.not_.is_(column, None)
 
+def _eq_filter(query, column, value):
     return query.eq(column, value)
 
 
-# ---------------------------------------------------------
-#   Helper: compute per-serving progress
-# ---------------------------------------------------------
-def _serving_progress(s):
-    cooking = (s.get("cooking_status") or "").lower()
-    portioning = (s.get("portioning_status") or "").lower()
+def apply_null_filter(query, column, value):
+    return _FILTER_DISPATCH.get(value, _eq_filter)(query, column, value)
 
-    completed = {"completed", "complete", "done"}
-    pending = {"pending", "in_progress", ""}
 
-    if portioning in completed:
-        return 1.0
-    if cooking in completed and portioning in pending:
-        return 0.5
-    return 0.0
+# ---------------------------------------------------------
+#   Status buckets used for per-serving progress
+#   (portioned = 1.0, cooked but not portioned = 0.5)
+# ---------------------------------------------------------
+_COMPLETED = frozenset(("completed", "complete", "done"))
+_PENDING = frozenset(("pending", "in_progress", ""))
 
 
 # ---------------------------------------------------------
@@ -161,7 +156,6 @@ def get_cooking_overview(start_date, end_date, filters):
     prefs = list(latest_pref_by_pair.values())
 
     # =====================================================
-        # =====================================================
     # 3.7️⃣ Fetch user display names from "user"
     # =====================================================
     users = []
@@ -218,7 +212,10 @@ def get_cooking_overview(start_date, end_date, filters):
     # =====================================================
     servings_query = (
         supabase.table("meal_plan_day_recipe_serving")
-        .select("*")
+        .select(
+            "id, meal_plan_day_recipe_id, subrecipe_id, "
+            "recipe_subrecipe_serving_calculated, cooking_status, portioning_status"
+        )
         .in_("meal_plan_day_recipe_id", mpdr_ids)
     )
 
@@ -230,6 +227,11 @@ def get_cooking_overview(start_date, end_date, filters):
     if not servings:
         return []
 
+    # Normalize statuses once so the progress loop doesn't re-lowercase them
+    for s in servings:
+        s["_cs"] = (s.get("cooking_status") or "").lower()
+        s["_ps"] = (s.get("portioning_status") or "").lower()
+
     # SORT SERVINGS TO ENSURE DETERMINISTIC ORDER
     servings.sort(key=lambda s: (s.get("subrecipe_id") or 0, s.get("id")))
 
@@ -238,72 +240,91 @@ def get_cooking_overview(start_date, end_date, filters):
     # =====================================================
     # 6️⃣ Subrecipes
     # =====================================================
-    subrecipes = (
-        supabase.table("subrecipe")
-        .select("*")
-        .in_("id", subrecipe_ids)
-        .execute()
-        .data
-    )
+    # Skip the lookups below when every serving has a null subrecipe_id
+    subrecipes = []
+    if subrecipe_ids:
+        subrecipes = (
+            supabase.table("subrecipe")
+            .select("*")
+            .in_("id", subrecipe_ids)
+            .execute()
+            .data
+        )
     subrecipe_map = {s["id"]: s for s in subrecipes}
+    subrecipe_sort_key = {s["id"]: (s["name"] or "").lower() for s in subrecipes}
 
     # =====================================================
     # 7️⃣ Subrecipe ingredients
     # =====================================================
-    subrec_ingred = (
-        supabase.table("subrec_ingred")
-        .select("*")
-        .in_("subrecipe_id", subrecipe_ids)
-        .execute()
-        .data
-    )
+    subrec_ingred = []
+    if subrecipe_ids:
+        subrec_ingred = (
+            supabase.table("subrec_ingred")
+            .select("*")
+            .in_("subrecipe_id", subrecipe_ids)
+            .execute()
+            .data
+        )
 
     ingredient_ids = list({i["ingredient_id"] for i in subrec_ingred})
 
-    ingredients = (
-        supabase.table("ingredient")
-        .select("*")
-        .in_("id", ingredient_ids)
-        .execute()
-        .data
-    )
+    ingredients = []
+    if ingredient_ids:
+        ingredients = (
+            supabase.table("ingredient")
+            .select("*")
+            .in_("id", ingredient_ids)
+            .execute()
+            .data
+        )
     ingredient_map = {i["id"]: i for i in ingredients}
+    # lowercased names computed once, reused by every ingredient-list sort
+    ingredient_sort_key = {i["id"]: (i["name"] or "").lower() for i in ingredients}
 
-    subrec_ing_map = defaultdict(list)
-    for ing in subrec_ingred:
-        subrec_ing_map[ing["subrecipe_id"]].append(ing)
+    subrec_ingred.sort(key=itemgetter("subrecipe_id"))
+    subrec_ing_map = {
+        sub_id: list(rows)
+        for sub_id, rows in groupby(subrec_ingred, itemgetter("subrecipe_id"))
+    }
 
     # =====================================================
     # 8️⃣ Build final output
     # =====================================================
     output = []
 
+    # earliest eating date + mpdr rows per recipe, in one pass over mpdr
+    earliest_by_recipe = {}
+    mpdr_by_recipe = defaultdict(list)
+    for r in mpdr:
+        d = mpd_map[r["meal_plan_day_id"]]["date"]
+        rid = r["recipe_id"]
+        mpdr_by_recipe[rid].append(r)
+        if rid not in earliest_by_recipe or d < earliest_by_recipe[rid]:
+            earliest_by_recipe[rid] = d
+
+    # servings per recipe; a single pass over the sorted servings keeps
+    # each recipe's servings in (subrecipe_id, id) order
+    recipe_by_mpdr = {r["id"]: r["recipe_id"] for r in mpdr}
+    servings_by_recipe = defaultdict(list)
+    for s in servings:
+        servings_by_recipe[recipe_by_mpdr[s["meal_plan_day_recipe_id"]]].append(s)
+
     # SORT RECIPES BY EARLIEST DATE
-    recipe_ids_sorted = sorted(
-        recipe_ids,
-        key=lambda rid: min(
-            mpd_map[r["meal_plan_day_id"]]["date"]
-            for r in mpdr
-            if r["recipe_id"] == rid
-        )
-    )
+    recipe_ids_sorted = sorted(recipe_ids, key=earliest_by_recipe.__getitem__)
 
     for recipe_id in recipe_ids_sorted:
         recipe = recipe_map.get(recipe_id)
         if not recipe:
             continue
 
-        mpdr_for_recipe = [r for r in mpdr if r["recipe_id"] == recipe_id]
+        mpdr_for_recipe = mpdr_by_recipe[recipe_id]
         mpdr_ids_for_recipe = [r["id"] for r in mpdr_for_recipe]
 
-        recipe_servings = [
-            s for s in servings if s["meal_plan_day_recipe_id"] in mpdr_ids_for_recipe
-        ]
+        recipe_servings = servings_by_recipe.get(recipe_id)
         if not recipe_servings:
             continue
 
-        dates = [mpd_map[r["meal_plan_day_id"]]["date"] for r in mpdr_for_recipe]
-        earliest_date = min(dates)
+        earliest_date = earliest_by_recipe[recipe_id]
 
         # ------------------------------------------
         # 🟦 RECIPE-LEVEL INGREDIENTS (sorted alphabetically)
@@ -317,7 +338,7 @@ def get_cooking_overview(start_date, end_date, filters):
 
             multiplier = s["recipe_subrecipe_serving_calculated"] or 0
 
-            for ing in subrec_ing_map[sub_id]:
+            for ing in subrec_ing_map.get(sub_id, ()):
                 ing_id = ing["ingredient_id"]
                 base_qty = ing["quantity"] or 0
 
@@ -326,41 +347,54 @@ def get_cooking_overview(start_date, end_date, filters):
 
                 recipe_ing_totals[ing_id] += base_qty * multiplier * serving_per_unit
 
-        ingredient_list = sorted(
-            [
-                {
-                    "ingredient_id": ing_id,
-                    "name": ingredient_map[ing_id]["name"],
-                    "unit": ingredient_map[ing_id]["unit"],
-                    "total_quantity": round(qty, 1),
-                }
-                for ing_id, qty in recipe_ing_totals.items()
-            ],
-            key=lambda x: x["name"].lower(),
-        )
+        ingredient_list = [
+            {
+                "ingredient_id": ing_id,
+                "name": ingredient_map[ing_id]["name"],
+                "unit": ingredient_map[ing_id]["unit"],
+                "total_quantity": round(recipe_ing_totals[ing_id], 1),
+            }
+            for ing_id in sorted(recipe_ing_totals, key=ingredient_sort_key.__getitem__)
+        ]
 
         # ------------------------------------------
         # 🟧 SUBRECIPES (sorted alphabetically)
         # ------------------------------------------
-        servings_by_sub = defaultdict(list)
-        for s in recipe_servings:
-            if s["subrecipe_id"]:
-                servings_by_sub[s["subrecipe_id"]].append(s)
+        # recipe_servings is already ordered by subrecipe_id
+        servings_by_sub = {
+            sub_id: list(rows)
+            for sub_id, rows in groupby(recipe_servings, itemgetter("subrecipe_id"))
+            if sub_id
+        }
 
         subrecipe_list = []
 
-        for sub_id, sub_servings in servings_by_sub.items():
+        # iterate in alphabetical order so the list is built already sorted
+        for sub_id, sub_servings in sorted(
+            servings_by_sub.items(),
+            key=lambda kv: subrecipe_sort_key.get(kv[0], ""),
+        ):
             sub = subrecipe_map.get(sub_id)
             if not sub:
                 continue
 
-            total_servings = sum(
-                (s["recipe_subrecipe_serving_calculated"] or 0) for s in sub_servings
-            )
+            # single pass: total servings, progress sum and serving ids
+            total_servings = 0
+            progress_sum = 0.0
+            serving_ids = []
+            for s in sub_servings:
+                total_servings += s["recipe_subrecipe_serving_calculated"] or 0
+                cooking = s["_cs"]
+                portioning = s["_ps"]
+                progress_sum += (
+                    1.0 if portioning in _COMPLETED
+                    else 0.5 if cooking in _COMPLETED and portioning in _PENDING
+                    else 0.0
+                )
+                serving_ids.append(s["id"])
 
             # progress (avg of serving progresses)
-            progress_values = [_serving_progress(s) for s in sub_servings]
-            sub_progress = int((sum(progress_values) / len(progress_values)) * 100)
+            sub_progress = int((progress_sum / len(sub_servings)) * 100)
 
             if sub_progress == 100:
                 sub_status = "completed"
@@ -371,7 +405,7 @@ def get_cooking_overview(start_date, end_date, filters):
 
             # SUBRECIPE INGREDIENTS (sorted alphabetically)
             sub_ing_totals = defaultdict(float)
-            for ing in subrec_ing_map[sub_id]:
+            for ing in subrec_ing_map.get(sub_id, ()):
                 ing_id = ing["ingredient_id"]
                 base_qty = ing["quantity"] or 0
 
@@ -380,18 +414,15 @@ def get_cooking_overview(start_date, end_date, filters):
 
                 sub_ing_totals[ing_id] += base_qty * total_servings * serving_per_unit
 
-            sub_ing_list = sorted(
-                [
-                    {
-                        "ingredient_id": ing_id,
-                        "name": ingredient_map[ing_id]["name"],
-                        "unit": ingredient_map[ing_id]["unit"],
-                        "quantity": round(qty, 1),
-                    }
-                    for ing_id, qty in sub_ing_totals.items()
-                ],
-                key=lambda x: x["name"].lower(),
-            )
+            sub_ing_list = [
+                {
+                    "ingredient_id": ing_id,
+                    "name": ingredient_map[ing_id]["name"],
+                    "unit": ingredient_map[ing_id]["unit"],
+                    "quantity": round(sub_ing_totals[ing_id], 1),
+                }
+                for ing_id in sorted(sub_ing_totals, key=ingredient_sort_key.__getitem__)
+            ]
 
             subrecipe_list.append(
                 {
@@ -402,14 +433,11 @@ def get_cooking_overview(start_date, end_date, filters):
                     "status": sub_status,
                     "progress": sub_progress,
                     "total_servings": total_servings,
-                    "selected_meal_plan_day_recipe_serving_id": [s["id"] for s in sub_servings],
+                    "selected_meal_plan_day_recipe_serving_id": serving_ids,
                     "ingredients_needed": sub_ing_list,
                 }
             )
 
-        # SORT SUBRECIPES ALPHABETICALLY
-        subrecipe_list = sorted(subrecipe_list, key=lambda x: x["name"].lower())
-
         # ------------------------------------------------
         # 🟥 RECIPE PROGRESS = average of subrecipe progress
         # ------------------------------------------------
@@ -434,7 +462,7 @@ def get_cooking_overview(start_date, end_date, filters):
             }
         )
 
-    # FINAL SORT: recipes by earliest date
-    output = sorted(output, key=lambda r: r["earliest_date"])
+    # recipes were appended in earliest-date order (recipe_ids_sorted),
+    # so no final re-sort is needed
 
     return output
@@ -3,13 +3,21 @@ from utils.supabase_client import supabase
 
 def get_ingredients_to_buy(start_date, end_date, recipe=None, client=None, delivery_slot=None):
 
+    # recipe_id is an integer column: a non-numeric recipe filter matches
+    # nothing, so answer without querying
+    if recipe:
+        try:
+            recipe = int(recipe)
+        except (TypeError, ValueError):
+            return []
+
     # ---------------------------------------------------------
     # 1. Fetch deliveries within date range
     # ---------------------------------------------------------
     q = (
         supabase
         .table("deliveries")
-        .select("id, meal_plan_day_id")
+        .select("meal_plan_day_id")
         .gte("delivery_date", start_date)
         .lte("delivery_date", end_date)
     )
@@ -27,36 +35,24 @@ def get_ingredients_to_buy(start_date, end_date, recipe=None, client=None, deliv
     meal_plan_day_ids = [d["meal_plan_day_id"] for d in deliveries if d["meal_plan_day_id"]]
 
     # ---------------------------------------------------------
-    # 2. Fetch meal_plan_day_recipe rows for these days
+    # 2. Fetch servings (meal_plan_day_recipe_serving) for these days,
+    #    joined to meal_plan_day_recipe so the day/recipe filters run
+    #    server-side in the same round trip
     # ---------------------------------------------------------
-    mprd = (
+    q = (
         supabase
-        .table("meal_plan_day_recipe")
-        .select("id, recipe_id, meal_plan_day_id")
-        .in_("meal_plan_day_id", meal_plan_day_ids)
-        .execute()
-        .data
+        .table("meal_plan_day_recipe_serving")
+        .select(
+            "subrecipe_id, recipe_subrecipe_serving_calculated, "
+            "meal_plan_day_recipe!inner(recipe_id, meal_plan_day_id)"
+        )
+        .in_("meal_plan_day_recipe.meal_plan_day_id", meal_plan_day_ids)
     )
 
     if recipe:
-        mprd = [r for r in mprd if str(r["recipe_id"]) == str(recipe)]
-
-    if not mprd:
-        return []
-
-    meal_plan_day_recipe_ids = [r["id"] for r in mprd]
+        q = q.eq("meal_plan_day_recipe.recipe_id", recipe)
 
-    # ---------------------------------------------------------
-    # 3. Fetch servings (meal_plan_day_recipe_serving)
-    # ---------------------------------------------------------
-    servings = (
-        supabase
-        .table("meal_plan_day_recipe_serving")
-        .select("id, subrecipe_id, recipe_subrecipe_serving_calculated, meal_plan_day_recipe_id")
-        .in_("meal_plan_day_recipe_id", meal_plan_day_recipe_ids)
-        .execute()
-        .data
-    )
+    servings = q.execute().data
 
     if not servings:
         return []
@@ -64,7 +60,7 @@ def get_ingredients_to_buy(start_date, end_date, recipe=None, client=None, deliv
     subrecipe_ids = list({s["subrecipe_id"] for s in servings})
 
     # ---------------------------------------------------------
-    # 4. Fetch ingredients for these subrecipes
+    # 3. Fetch ingredients for these subrecipes
     # ---------------------------------------------------------
     ingred_rows = (
     supabase
@@ -84,48 +80,45 @@ def get_ingredients_to_buy(start_date, end_date, recipe=None, client=None, deliv
     .data
     )
 
-
-    ingred_map = {}
-    for row in ingred_rows:
-        ingred_map.setdefault(row["subrecipe_id"], []).append(row)
-
-    # ---------------------------------------------------------
-    # 5. Multiply servings × ingredient quantities
-    # ---------------------------------------------------------
     # ---------------------------------------------
-    # 5. Multiply servings × ingredient quantities
+    # 4. Multiply servings × ingredient quantities
+    #    Servings are summed per subrecipe first, so each ingredient row
+    #    is multiplied once instead of once per serving.
     # ---------------------------------------------
-    totals = {}
-
+    servings_by_sub = {}
     for s in servings:
         sub_id = s["subrecipe_id"]
-        servings_count = s["recipe_subrecipe_serving_calculated"]
-
-        if sub_id not in ingred_map:
-            continue
-
-        for ing in ingred_map[sub_id]:
-            ing_id = ing["ingredient_id"]
-
-            base_qty = ing["quantity"] * servings_count
-            serving_per_unit = ing["ingredient"]["serving_per_unit"] or 1
+        servings_by_sub[sub_id] = (
+            servings_by_sub.get(sub_id, 0) + (s["recipe_subrecipe_serving_calculated"] or 0)
+        )
 
-            final_qty = base_qty * serving_per_unit
+    # Accumulate plain floats per ingredient; the output dicts are built
+    # once at the end instead of being looked up and mutated per row.
+    qty_by_ing = {}
+    ingredient_by_id = {}
 
-            if ing_id not in totals:
-                totals[ing_id] = {
-                    "ingredient_id": ing_id,
-                    "name": ing["ingredient"]["name"],
-                    "unit": ing["ingredient"]["unit"],
-                    "total_quantity": 0,
-                }
+    for ing in ingred_rows:
+        servings_count = servings_by_sub.get(ing["subrecipe_id"])
+        if servings_count is None:
+            continue
 
-            totals[ing_id]["total_quantity"] += final_qty
+        ing_id = ing["ingredient_id"]
+        qty_by_ing[ing_id] = qty_by_ing.get(ing_id, 0) + ing["quantity"] * servings_count
+        if ing_id not in ingredient_by_id:
+            ingredient_by_id[ing_id] = ing["ingredient"]
 
     # ---------------------------------------------
-    # 6. Sort ingredients alphabetically
+    # 5. Apply serving_per_unit once per ingredient, sort alphabetically
     # ---------------------------------------------
-    result = list(totals.values())
+    result = [
+        {
+            "ingredient_id": ing_id,
+            "name": ingredient_by_id[ing_id]["name"],
+            "unit": ingredient_by_id[ing_id]["unit"],
+            "total_quantity": base_qty * (ingredient_by_id[ing_id]["serving_per_unit"] or 1),
+        }
+        for ing_id, base_qty in qty_by_ing.items()
+    ]
     result.sort(key=lambda x: x["name"].lower())
 
     return result
@@ -1,9 +1,13 @@
+import copy
+import itertools
+import time
 from typing import Dict, Any, List, Tuple
 from collections import defaultdict
 
 from pulp import (
-    LpProblem, LpMinimize, LpVariable, lpSum, LpInteger, value,
-    PULP_CBC_CMD, LpStatus
+    LpProblem, LpMinimize, LpVariable, LpAffineExpression, LpInteger, value,
+    PULP_CBC_CMD,
+    LpSolutionOptimal, LpSolutionIntegerFeasible, LpSolutionInfeasible
 )
 from utils.supabase_client import supabase
 
@@ -26,6 +30,10 @@ SERVING_MIN_BY_STEP = {
 
 DEFAULT_MAX_SERVING = 3
 
+# Integer-step days whose whole serving grid has at most this many
+# combinations are solved by exact enumeration instead of a CBC subprocess.
+ENUMERATION_MAX_COMBOS = 4096
+
 # Meal-type kcal distribution caps (relative to TOTAL solved kcal, not target).
 BREAKFAST_MAX_PCT   = 0.40
 SNACK_MAX_PCT       = 0.25
@@ -42,87 +50,160 @@ WEIGHT_CARBS     = 1.0
 WEIGHT_FAT       = 1.0
 WEIGHT_KCAL_SOFT = 0.30
 
+# CBC settings for these small MIPs (a few dozen integer vars). One thread:
+# the models are too small to benefit from parallel B&B and gunicorn
+# workers already share the dyno's cores. The time limit caps pathological
+# instances (the incumbent found so far is still used); the relative gap
+# stops branch-and-bound once within 1% of the bound; a fixed seed keeps
+# solutions reproducible for the solution cache.
+CBC_TIME_LIMIT_SECONDS = 3
+CBC_GAP_REL = 0.01
+CBC_THREADS = 1
+CBC_OPTIONS = ["randomCbcSeed 1"]
+
+# Process-level cache of recipe -> subrecipes. Recipes repeat across the days
+# of a plan and across requests; the TTL bounds how long an admin edit to a
+# subrecipe's macros can take to show up (call clear_subrecipe_cache() to
+# drop it immediately). Least recently used recipes are evicted first.
+SUBRECIPE_CACHE_TTL_SECONDS = 300
+SUBRECIPE_CACHE_MAX_RECIPES = 2048
+
+# Solved days keyed by the full problem signature (subrecipes, macros, meal
+# types, targets), so identical days skip CBC entirely. Because macros are
+# part of the key, an edited subrecipe never hits a stale entry. Least
+# recently used days are evicted first. Only proven answers are stored: a
+# CBC incumbent cut short by the time limit or gap stop is returned to its
+# caller but solved again next time.
+SOLUTION_CACHE_MAX_ENTRIES = 4096
+
 
 # =============================================================================
 # DATA FETCHING
 # =============================================================================
 
+def _subrecipe_from_row(sub: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape an embedded `subrecipe` row into the optimizer's subrecipe dict."""
+    return {
+        "id":          sub.get("id"),
+        "name":        sub.get("name"),
+        "max_serving": sub.get("max_serving") or DEFAULT_MAX_SERVING,
+        "macros": {
+            "kcal":    float(sub.get("kcal")    or 0.0),
+            "protein": float(sub.get("protein") or 0.0),
+            "carbs":   float(sub.get("carbs")   or 0.0),
+            "fat":     float(sub.get("fat")     or 0.0),
+        },
+    }
+
+
+_subrecipe_cache: Dict[int, Tuple[float, Tuple[Dict[str, Any], ...]]] = {}
+
+
+def clear_subrecipe_cache(recipe_id: int | None = None) -> None:
+    """Drop one recipe's cached subrecipes, or every entry when recipe_id is None."""
+    if recipe_id is None:
+        _subrecipe_cache.clear()
+    else:
+        _subrecipe_cache.pop(recipe_id, None)
+
+
 def get_recipe_subrecipes(recipe_id: int) -> List[Dict[str, Any]]:
     """Return subrecipes linked to a recipe, enriched with per-serving macros."""
+    return get_subrecipes_by_recipe([recipe_id]).get(recipe_id, [])
+
+
+def get_subrecipes_by_recipe(recipe_ids: List[int]) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Batched get_recipe_subrecipes: one round trip for all recipe_ids that
+    are not already in the process cache.
+    Returns { recipe_id: [subrecipe, ...] }.
+    """
+    now = time.monotonic()
+    result: Dict[int, List[Dict[str, Any]]] = {}
+    missing: List[int] = []
+
+    for rid in set(recipe_ids):
+        hit = _subrecipe_cache.pop(rid, None)
+        if hit and now - hit[0] < SUBRECIPE_CACHE_TTL_SECONDS:
+            # Re-insert to mark as most recently used
+            _subrecipe_cache[rid] = hit
+            result[rid] = list(hit[1])
+        else:
+            missing.append(rid)
+
+    if not missing:
+        return result
+
     resp = (
         supabase.table("recipe_subrecipe")
-        .select("subrecipe(id, name, max_serving, kcal, protein, carbs, fat)")
-        .eq("recipe_id", recipe_id)
+        .select("recipe_id, subrecipe(id, name, max_serving, kcal, protein, carbs, fat)")
+        .in_("recipe_id", missing)
         .execute()
     )
 
-    subrecipes = []
+    subs_by_recipe: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
     for rs in resp.data or []:
-        sub = rs.get("subrecipe") or {}
-        subrecipes.append({
-            "id":          sub.get("id"),
-            "name":        sub.get("name"),
-            "max_serving": sub.get("max_serving") or DEFAULT_MAX_SERVING,
-            "macros": {
-                "kcal":    float(sub.get("kcal")    or 0.0),
-                "protein": float(sub.get("protein") or 0.0),
-                "carbs":   float(sub.get("carbs")   or 0.0),
-                "fat":     float(sub.get("fat")     or 0.0),
-            },
-        })
+        subs_by_recipe[rs["recipe_id"]].append(_subrecipe_from_row(rs.get("subrecipe") or {}))
 
-    return subrecipes
+    for rid in missing:
+        subs = tuple(subs_by_recipe.get(rid, ()))
+        _subrecipe_cache[rid] = (now, subs)
+        result[rid] = list(subs)
+
+    # Evict least recently used entries (dict keeps insertion order)
+    while len(_subrecipe_cache) > SUBRECIPE_CACHE_MAX_RECIPES:
+        _subrecipe_cache.pop(next(iter(_subrecipe_cache)))
+
+    return result
 
 
 # =============================================================================
 # HELPERS
 # =============================================================================
 
-def _compute_totals(all_subs: List[Dict], servings: Dict[int, float]) -> Dict[str, float]:
-    """Sum macros across all subrecipes given a servings dict {index: serving_count}."""
-    P = sum(servings[i] * s["macros"]["protein"] for i, s in enumerate(all_subs))
-    C = sum(servings[i] * s["macros"]["carbs"]   for i, s in enumerate(all_subs))
-    F = sum(servings[i] * s["macros"]["fat"]      for i, s in enumerate(all_subs))
-    K = sum(servings[i] * s["macros"]["kcal"]     for i, s in enumerate(all_subs))
-    return {"protein": P, "carbs": C, "fat": F, "kcal": K}
-
-
 def _build_result(
     all_subs: List[Dict],
-    recipes_by_meal: Dict[str, Dict],
     servings_map: Dict[int, float],
     loss: float | None,
     tolerance_label: Any,
 ) -> Tuple[List[Dict], float | None, Dict]:
-    """Package solver output into the canonical return format."""
-    totals = _compute_totals(all_subs, servings_map)
-
+    """
+    Package solver output into the canonical return format. Each
+    subrecipe's macros are read once and feed both its output row and the
+    running day totals.
+    """
+    total_P = total_C = total_F = total_K = 0
     optimized = []
     for i, s in enumerate(all_subs):
-        serv_val  = float(servings_map[i])
-        meal_key  = s["meal"]
-        meal_type = recipes_by_meal.get(meal_key, {}).get("meal_type")
-        mps       = s["macros"]
+        serving = servings_map[i]
+        serv_val = float(serving)
+        protein, carbs, fat, kcal = (
+            s["macros"]["protein"], s["macros"]["carbs"], s["macros"]["fat"], s["macros"]["kcal"]
+        )
+        total_P += serving * protein
+        total_C += serving * carbs
+        total_F += serving * fat
+        total_K += serving * kcal
 
         optimized.append({
             "subrecipe_id": s["subrecipe_id"],
             "name":         s["name"],
-            "meal_name":    meal_key,
-            "meal_type":    meal_type,
+            "meal_name":    s["meal"],
+            "meal_type":    s["meal_type"],
             "servings":     serv_val,
             "macros": {
-                "protein": mps["protein"] * serv_val,
-                "carbs":   mps["carbs"]   * serv_val,
-                "fat":     mps["fat"]     * serv_val,
-                "kcal":    mps["kcal"]    * serv_val,
+                "protein": protein * serv_val,
+                "carbs":   carbs   * serv_val,
+                "fat":     fat     * serv_val,
+                "kcal":    kcal    * serv_val,
             },
         })
 
     day_totals = {
-        "protein":       int(round(totals["protein"])),
-        "carbs":         int(round(totals["carbs"])),
-        "fat":           int(round(totals["fat"])),
-        "kcal":          int(round(totals["kcal"])),
+        "protein":       int(round(total_P)),
+        "carbs":         int(round(total_C)),
+        "fat":           int(round(total_F)),
+        "kcal":          int(round(total_K)),
         "tolerance_used": tolerance_label,
     }
 
@@ -135,7 +216,6 @@ def _build_result(
 
 def _safe_fallback(
     all_subs: List[Dict],
-    recipes_by_meal: Dict[str, Dict],
     P_t: float,
     C_t: float,
     F_t: float,
@@ -146,65 +226,142 @@ def _safe_fallback(
     Greedy fallback: start at 1 serving each, then greedily add servings to
     minimise protein deficit first (protein/kcal ratio), then to fill calories.
     """
-    servings = {i: 1 for i in range(len(all_subs))}
-
-    def best_protein_per_kcal() -> int:
-        return max(
-            range(len(all_subs)),
-            key=lambda i: (
-                all_subs[i]["macros"]["protein"] / max(all_subs[i]["macros"]["kcal"], 1)
-                if servings[i] < all_subs[i]["max_serving"] else -1
-            ),
-        )
-
-    def best_kcal() -> int:
-        return max(
-            range(len(all_subs)),
-            key=lambda i: (
-                all_subs[i]["macros"]["kcal"]
-                if servings[i] < all_subs[i]["max_serving"] else -1
-            ),
-        )
-
-    totals = _compute_totals(all_subs, servings)
+    n = len(all_subs)
+    servings = {i: 1 for i in range(n)}
+
+    # Flat per-subrecipe columns so the greedy scans below index plain lists
+    # instead of walking nested dicts.
+    prot     = [s["macros"]["protein"] for s in all_subs]
+    kcal     = [s["macros"]["kcal"]    for s in all_subs]
+    max_serv = [s["max_serving"]       for s in all_subs]
+    protein_per_kcal = [p / max(k, 1) for p, k in zip(prot, kcal)]
+
+    # The rankings never change; only the max_serving cap removes candidates
+    # (and never re-admits them), so each phase walks a pre-sorted order with
+    # a forward-only pointer. Stable sorts keep max()'s lowest-index tie-break.
+    protein_order = sorted(range(n), key=lambda i: -protein_per_kcal[i])
+    kcal_order    = sorted(range(n), key=lambda i: -kcal[i])
+
+    def next_eligible(order: List[int], ptr: int) -> int:
+        while ptr < n and servings[order[ptr]] >= max_serv[order[ptr]]:
+            ptr += 1
+        return ptr
+
+    # Running totals: only one serving changes per step, so apply its delta
+    # instead of re-summing every subrecipe.
+    total_P = sum(prot)
+    total_K = sum(kcal)
 
     # Phase 1: push protein toward target
-    while totals["protein"] < P_t and totals["kcal"] < 1.2 * kcal_t:
-        idx = best_protein_per_kcal()
-        if servings[idx] >= all_subs[idx]["max_serving"]:
+    ptr = 0
+    while total_P < P_t and total_K < 1.2 * kcal_t:
+        ptr = next_eligible(protein_order, ptr)
+        if ptr == n:
             break
+        idx = protein_order[ptr]
         servings[idx] += 1
-        totals = _compute_totals(all_subs, servings)
+        total_P += prot[idx]
+        total_K += kcal[idx]
 
     # Phase 2: fill calories (only if under-kcal is not allowed)
     if not allow_under_kcal:
-        while totals["kcal"] < 0.80 * kcal_t:
-            idx = best_kcal()
-            if servings[idx] >= all_subs[idx]["max_serving"]:
+        ptr = 0
+        while total_K < 0.80 * kcal_t:
+            ptr = next_eligible(kcal_order, ptr)
+            if ptr == n:
                 break
+            idx = kcal_order[ptr]
             servings[idx] += 1
-            totals = _compute_totals(all_subs, servings)
+            total_K += kcal[idx]
+
+    return _build_result(all_subs, servings, None, "SAFE_FALLBACK")
+
+
+# =============================================================================
+# MEAL-TYPE DISTRIBUTION RULES
+# =============================================================================
+
+# Meal-type presence is packed into a bitmask; each handled combination maps
+# to the caps it gets. Combinations missing from the table (single meals other
+# than breakfast, unrecognised mixes) get no distribution constraint.
+# Rules return their constraints, so they work on LP expressions (giving
+# LpConstraints) and on plain numbers (giving bools) alike.
+_SNACK, _BREAKFAST, _DINNER, _LUNCH = 1, 2, 4, 8
+MEAL_TYPE_BITS = {"snack": _SNACK, "breakfast": _BREAKFAST, "dinner": _DINNER, "lunch": _LUNCH}
+
+
+def _snack_cap(kcal_by_type: Dict[str, Any], total_K: Any) -> List[Any]:
+    return [kcal_by_type["snack"] <= SNACK_MAX_PCT * total_K]
+
+
+def _breakfast_cap(kcal_by_type: Dict[str, Any], total_K: Any) -> List[Any]:
+    return [kcal_by_type["breakfast"] <= BREAKFAST_MAX_PCT * total_K]
+
+
+def _dinner_lunch_balance(kcal_by_type: Dict[str, Any], total_K: Any) -> List[Any]:
+    return [
+        kcal_by_type["dinner"] - kcal_by_type["lunch"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["lunch"],
+        kcal_by_type["lunch"] - kcal_by_type["dinner"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["dinner"],
+    ]
+
+
+def _lunch_cap_no_dinner(kcal_by_type: Dict[str, Any], total_K: Any) -> List[Any]:
+    return [kcal_by_type["lunch"] <= NO_DINNER_YES_LUNCH_PCT * total_K]
+
+
+def _dinner_cap_no_lunch(kcal_by_type: Dict[str, Any], total_K: Any) -> List[Any]:
+    return [kcal_by_type["dinner"] <= NO_LUNCH_YES_DINNER_PCT * total_K]
+
+
+_MEAL_DISTRIBUTION_RULES = {
+    _BREAKFAST | _LUNCH | _DINNER | _SNACK: (_snack_cap, _breakfast_cap, _dinner_lunch_balance),
+    _SNACK | _LUNCH | _DINNER:              (_snack_cap, _dinner_lunch_balance),
+    _LUNCH | _DINNER:                       (_dinner_lunch_balance,),
+    _BREAKFAST | _LUNCH | _SNACK:           (_snack_cap, _breakfast_cap, _lunch_cap_no_dinner),
+    _BREAKFAST | _DINNER | _SNACK:          (_snack_cap, _breakfast_cap, _dinner_cap_no_lunch),
+    _SNACK | _DINNER:                       (_snack_cap,),
+    _SNACK | _LUNCH:                        (_snack_cap,),
+    _BREAKFAST | _SNACK:                    (_snack_cap, _breakfast_cap),
+    _BREAKFAST:                             (_breakfast_cap,),
+}
+
 
-    return _build_result(all_subs, recipes_by_meal, servings, None, "SAFE_FALLBACK")
+def _meal_distribution_rules(meal_types) -> Tuple[Any, ...]:
+    """Rule set for the meal types present in a day."""
+    mask = 0
+    for meal_type in meal_types:
+        mask |= MEAL_TYPE_BITS.get(meal_type, 0)
+    return _MEAL_DISTRIBUTION_RULES.get(mask, ())
 
 
 # =============================================================================
 # CORE LP SOLVER
 # =============================================================================
 
-def _solve_lp_once(
+def _cbc_solver(warm_start: bool = False) -> PULP_CBC_CMD:
+    """CBC command tuned for the small per-day MIPs built below."""
+    return PULP_CBC_CMD(
+        msg=False,
+        presolve=True,
+        timeLimit=CBC_TIME_LIMIT_SECONDS,
+        gapRel=CBC_GAP_REL,
+        threads=CBC_THREADS,
+        warmStart=warm_start,
+        options=CBC_OPTIONS,
+    )
+
+
+def _build_lp(
     all_subs: List[Dict],
-    recipes_by_meal: Dict[str, Dict],
     P_t: float,
     C_t: float,
     F_t: float,
     kcal_t: float,
     serving_step: float,
-    tol: float,
     allow_under_kcal: bool,
-) -> Tuple[List[Dict], float, Dict] | None:
+) -> Dict[str, Any]:
     """
-    Build and solve one LP instance.
+    Build one LP instance for a given serving step.
 
     Key design decisions vs. the old version
     -----------------------------------------
@@ -221,51 +378,60 @@ def _solve_lp_once(
        (the LP variable), not the fixed target kcal_t.  When the solver
        drifts slightly above/below kcal_t the proportions stay meaningful.
 
-    4. The meal-type branching uses a proper elif chain, preventing
-       multiple conflicting constraint blocks from firing simultaneously.
+    4. The meal-type caps come from one lookup of the meal-type bitmask in
+       _MEAL_DISTRIBUTION_RULES, so exactly one rule set applies per day.
 
-    Returns None if the LP is infeasible or non-optimal.
+    5. Only the kcal band depends on the tolerance, so the model is built
+       once per serving step and _solve_lp_once moves the band's RHS for
+       each tolerance instead of rebuilding every variable and constraint.
     """
     serving_min = SERVING_MIN_BY_STEP.get(serving_step, 1.0)
-    label = f"MealPlan_tol{int(tol * 100)}_step{serving_step}"
 
-    prob = LpProblem(label, LpMinimize)
+    prob = LpProblem(f"MealPlan_step{serving_step}", LpMinimize)
 
     # ------------------------------------------------------------------
     # Decision variables
     # ------------------------------------------------------------------
+    # Variables share name prefix, category and lower bound, so they are
+    # created in one LpVariable.dicts call; only the upper bound varies.
+    n = len(all_subs)
     if serving_step == 1.0:
-        x = {
-            i: LpVariable(
-                f"x_{i}",
-                lowBound=int(serving_min),
-                upBound=int(s["max_serving"]),
-                cat=LpInteger,
-            )
-            for i, s in enumerate(all_subs)
-        }
-        servings_expr = x
+        x = LpVariable.dicts("x", range(n), lowBound=int(serving_min), cat=LpInteger)
+        for i, s in enumerate(all_subs):
+            x[i].upBound = int(s["max_serving"])
+        units = x
     else:
         # Half-step: encode as integer multiples of serving_step
         min_units = int(round(serving_min / serving_step))
-        y = {
-            i: LpVariable(
-                f"y_{i}",
-                lowBound=min_units,
-                upBound=int(round(float(all_subs[i]["max_serving"]) / serving_step)),
-                cat=LpInteger,
-            )
-            for i in range(len(all_subs))
-        }
-        servings_expr = {i: serving_step * y[i] for i in range(len(all_subs))}
+        y = LpVariable.dicts("y", range(n), lowBound=min_units, cat=LpInteger)
+        for i, s in enumerate(all_subs):
+            y[i].upBound = int(round(float(s["max_serving"]) / serving_step))
+        units = y
+
+    # servings[i] == serving_step * units[i]; the step is folded into each
+    # coefficient below rather than materialised as per-variable products.
 
     # ------------------------------------------------------------------
-    # Aggregate macro expressions
+    # Aggregate macro expressions (one pass collects every (var, coef)
+    # list, including the per-meal-type kcal terms used further down)
     # ------------------------------------------------------------------
-    total_P = lpSum(servings_expr[i] * s["macros"]["protein"] for i, s in enumerate(all_subs))
-    total_C = lpSum(servings_expr[i] * s["macros"]["carbs"]   for i, s in enumerate(all_subs))
-    total_F = lpSum(servings_expr[i] * s["macros"]["fat"]     for i, s in enumerate(all_subs))
-    total_K = lpSum(servings_expr[i] * s["macros"]["kcal"]    for i, s in enumerate(all_subs))
+    p_terms, c_terms, f_terms, k_terms = [], [], [], []
+    kcal_terms_by_type: Dict[str, List[Any]] = defaultdict(list)
+    for i, s in enumerate(all_subs):
+        var = units[i]
+        mps = s["macros"]
+        kcal_term = (var, serving_step * mps["kcal"])
+        p_terms.append((var, serving_step * mps["protein"]))
+        c_terms.append((var, serving_step * mps["carbs"]))
+        f_terms.append((var, serving_step * mps["fat"]))
+        k_terms.append(kcal_term)
+        if s["meal_type"]:
+            kcal_terms_by_type[s["meal_type"]].append(kcal_term)
+
+    total_P = LpAffineExpression(p_terms)
+    total_C = LpAffineExpression(c_terms)
+    total_F = LpAffineExpression(f_terms)
+    total_K = LpAffineExpression(k_terms)
 
     # ------------------------------------------------------------------
     # Absolute deviation variables (|total - target| via two-sided constraints)
@@ -292,134 +458,379 @@ def _solve_lp_once(
     safe_F = max(F_t, 1.0)
     safe_K = max(kcal_t, 1.0)
 
-    prob += (
+    objective = (
         WEIGHT_PROTEIN   * (dev_P / safe_P)
         + WEIGHT_CARBS   * (dev_C / safe_C)
         + WEIGHT_FAT     * (dev_F / safe_F)
         + WEIGHT_KCAL_SOFT * (dev_K / safe_K)
     )
+    prob += objective
 
     # ------------------------------------------------------------------
-    # Hard kcal band constraint
+    # Hard kcal band constraint (RHS set per tolerance by _solve_lp_once)
     # ------------------------------------------------------------------
-    prob += total_K <= (1.0 + tol) * kcal_t
+    kcal_upper = total_K <= kcal_t
+    prob += kcal_upper
+    kcal_lower = None
     if not allow_under_kcal:
-        prob += total_K >= (1.0 - tol) * kcal_t
+        kcal_lower = total_K >= kcal_t
+        prob += kcal_lower
 
     # ------------------------------------------------------------------
     # Meal-type kcal distribution constraints
     # Caps are relative to total_K (not the fixed kcal_t) so they stay
     # proportionally meaningful when the solver drifts within the band.
-    # Uses a single elif chain to avoid multiple blocks firing at once.
     # ------------------------------------------------------------------
-    kcal_by_type: Dict[str, Any] = defaultdict(int)
-    for i, s in enumerate(all_subs):
-        meal_key  = s["meal"]
-        meal_type = recipes_by_meal.get(meal_key, {}).get("meal_type")
-        if meal_type:
-            kcal_by_type[meal_type] = kcal_by_type[meal_type] + servings_expr[i] * s["macros"]["kcal"]
-
-    types = set(kcal_by_type.keys())
-
-    has_breakfast = "breakfast" in types
-    has_lunch     = "lunch"     in types
-    has_dinner    = "dinner"    in types
-    has_snack     = "snack"     in types
-
-    if has_breakfast and has_lunch and has_dinner and has_snack:
-        prob += kcal_by_type["snack"]     <= SNACK_MAX_PCT     * total_K
-        prob += kcal_by_type["breakfast"] <= BREAKFAST_MAX_PCT * total_K
-        prob += kcal_by_type["dinner"] - kcal_by_type["lunch"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["lunch"]
-        prob += kcal_by_type["lunch"] - kcal_by_type["dinner"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["dinner"]
-
-    elif has_snack and has_lunch and has_dinner and not has_breakfast:
-        prob += kcal_by_type["snack"] <= SNACK_MAX_PCT * total_K
-        prob += kcal_by_type["dinner"] - kcal_by_type["lunch"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["lunch"]
-        prob += kcal_by_type["lunch"] - kcal_by_type["dinner"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["dinner"]
-
-    elif has_lunch and has_dinner and not has_snack and not has_breakfast:
-        prob += kcal_by_type["dinner"] - kcal_by_type["lunch"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["lunch"]
-        prob += kcal_by_type["lunch"] - kcal_by_type["dinner"] <= DINNER_LUNCH_DIFF_PCT * kcal_by_type["dinner"]
-
-    elif has_breakfast and has_lunch and has_snack and not has_dinner:
-        prob += kcal_by_type["snack"]     <= SNACK_MAX_PCT     * total_K
-        prob += kcal_by_type["breakfast"] <= BREAKFAST_MAX_PCT * total_K
-        prob += kcal_by_type["lunch"]     <= NO_DINNER_YES_LUNCH_PCT * total_K
-
-    elif has_breakfast and has_dinner and has_snack and not has_lunch:
-        prob += kcal_by_type["snack"]     <= SNACK_MAX_PCT     * total_K
-        prob += kcal_by_type["breakfast"] <= BREAKFAST_MAX_PCT * total_K
-        prob += kcal_by_type["dinner"]    <= NO_LUNCH_YES_DINNER_PCT * total_K
+    kcal_by_type: Dict[str, Any] = {
+        meal_type: LpAffineExpression(terms)
+        for meal_type, terms in kcal_terms_by_type.items()
+    }
 
-    elif has_snack and has_dinner and not has_lunch and not has_breakfast:
-        prob += kcal_by_type["snack"] <= SNACK_MAX_PCT * total_K
+    for rule in _meal_distribution_rules(kcal_by_type):
+        for constraint in rule(kcal_by_type, total_K):
+            prob += constraint
+
+    return {
+        "prob":         prob,
+        "units":        units,
+        "serving_step": serving_step,
+        "kcal_t":       kcal_t,
+        "kcal_upper":   kcal_upper,
+        "kcal_lower":   kcal_lower,
+        "objective":    objective,
+    }
 
-    elif has_snack and has_lunch and not has_dinner and not has_breakfast:
-        prob += kcal_by_type["snack"] <= SNACK_MAX_PCT * total_K
 
-    elif has_breakfast and has_snack and not has_lunch and not has_dinner:
-        prob += kcal_by_type["snack"]     <= SNACK_MAX_PCT     * total_K
-        prob += kcal_by_type["breakfast"] <= BREAKFAST_MAX_PCT * total_K
+def _solve_lp_once(
+    model: Dict[str, Any],
+    all_subs: List[Dict],
+    tol: float,
+    warm_start: Dict[int, float] | None = None,
+    servings_hint_out: Dict[int, float] | None = None,
+) -> Tuple[List[Dict], float, Dict] | None:
+    """
+    Solve a model from _build_lp with the kcal band set to +/- tol.
 
-    elif has_breakfast and not has_snack and not has_lunch and not has_dinner:
-        prob += kcal_by_type["breakfast"] <= BREAKFAST_MAX_PCT * total_K
+    warm_start        : optional {index: servings} used as CBC's initial
+                        incumbent (snapped to this step's grid).
+    servings_hint_out : if given and the solve fails, filled with the last
+                        servings values CBC reported, so the next (finer)
+                        attempt can warm-start from them.
 
-    # All other single-meal or unrecognised combinations: no distribution constraint.
+    Returns None if the LP is infeasible or non-optimal.
+    """
+    prob         = model["prob"]
+    units        = model["units"]
+    serving_step = model["serving_step"]
+    kcal_t       = model["kcal_t"]
+
+    prob.name = f"MealPlan_tol{int(tol * 100)}_step{serving_step}"
+    model["kcal_upper"].changeRHS((1.0 + tol) * kcal_t)
+    if model["kcal_lower"] is not None:
+        model["kcal_lower"].changeRHS((1.0 - tol) * kcal_t)
+
+    if warm_start:
+        for i, v in warm_start.items():
+            var = units[i]
+            n_units = round(v / serving_step)
+            var.setInitialValue(min(max(n_units, var.lowBound), var.upBound))
 
     # ------------------------------------------------------------------
     # Solve
     # ------------------------------------------------------------------
-    prob.solve(PULP_CBC_CMD(msg=False))
-
-    if LpStatus[prob.status] != "Optimal":
+    prob.solve(_cbc_solver(warm_start=bool(warm_start)))
+
+    # Accept proven optima and incumbents returned on time limit / gap stop
+    if prob.sol_status not in (LpSolutionOptimal, LpSolutionIntegerFeasible):
+        if servings_hint_out is not None:
+            for i in range(len(all_subs)):
+                v = units[i].varValue
+                if v is not None:
+                    servings_hint_out[i] = serving_step * float(v)
         return None
 
-    # Reconstruct integer servings from LP solution
-    solved_servings = {
-        i: float(value(servings_expr[i]))
-        for i in range(len(all_subs))
-    }
+    total_error = float(value(model["objective"]))
+    servings = [serving_step * float(units[i].varValue) for i in range(len(all_subs))]
 
-    total_error = float(value(
-        WEIGHT_PROTEIN   * (dev_P / safe_P)
-        + WEIGHT_CARBS   * (dev_C / safe_C)
-        + WEIGHT_FAT     * (dev_F / safe_F)
-        + WEIGHT_KCAL_SOFT * (dev_K / safe_K)
-    ))
+    return _solved_day_result(all_subs, servings, total_error, tol, serving_step)
 
-    day_totals = {
-        "protein":          int(round(value(total_P))),
-        "carbs":            int(round(value(total_C))),
-        "fat":              int(round(value(total_F))),
-        "kcal":             int(round(value(total_K))),
-        "tolerance_used":   tol,
-        "serving_step_used": serving_step,
-    }
 
+def _solved_day_result(
+    all_subs: List[Dict],
+    servings: List[float],
+    total_error: float,
+    tol: float,
+    serving_step: float,
+) -> Tuple[List[Dict], float, Dict]:
+    """
+    Package an exact solve (LP or enumeration) into the canonical return format.
+    Per-subrecipe macros and day totals are computed in a single pass.
+    """
+    total_P = total_C = total_F = total_K = 0
     optimized = []
-    for i, s in enumerate(all_subs):
-        serv_val  = solved_servings[i]
-        meal_key  = s["meal"]
-        meal_type = recipes_by_meal.get(meal_key, {}).get("meal_type")
-        mps       = s["macros"]
+    for s, serv_val in zip(all_subs, servings):
+        mps   = s["macros"]
+        sub_P = mps["protein"] * serv_val
+        sub_C = mps["carbs"]   * serv_val
+        sub_F = mps["fat"]     * serv_val
+        sub_K = mps["kcal"]    * serv_val
+        total_P += sub_P
+        total_C += sub_C
+        total_F += sub_F
+        total_K += sub_K
 
         optimized.append({
             "subrecipe_id": s["subrecipe_id"],
             "name":         s["name"],
-            "meal_name":    meal_key,
-            "meal_type":    meal_type,
+            "meal_name":    s["meal"],
+            "meal_type":    s["meal_type"],
             "servings":     serv_val,
             "macros": {
-                "protein": mps["protein"] * serv_val,
-                "carbs":   mps["carbs"]   * serv_val,
-                "fat":     mps["fat"]     * serv_val,
-                "kcal":    mps["kcal"]    * serv_val,
+                "protein": sub_P,
+                "carbs":   sub_C,
+                "fat":     sub_F,
+                "kcal":    sub_K,
             },
         })
 
+    day_totals = {
+        "protein":          int(round(total_P)),
+        "carbs":            int(round(total_C)),
+        "fat":              int(round(total_F)),
+        "kcal":             int(round(total_K)),
+        "tolerance_used":   tol,
+        "serving_step_used": serving_step,
+    }
+
     return optimized, total_error, day_totals
 
 
+# =============================================================================
+# EXACT ENUMERATION (small integer-step days)
+# =============================================================================
+
+def _enumerate_integer_grid(
+    all_subs: List[Dict],
+    P_t: float,
+    C_t: float,
+    F_t: float,
+    kcal_t: float,
+) -> List[Tuple[float, float, Tuple[int, ...]]] | None:
+    """
+    Score every integer-step serving combination against the same objective
+    and meal-type caps as _build_lp (step 1.0), on the subrecipes' real macros.
+
+    Returns [(objective, total_K, servings), ...] for combinations that satisfy
+    the meal-type caps, sorted by objective (ties keep enumeration order), or
+    None when the grid has more than ENUMERATION_MAX_COMBOS combinations. The
+    kcal band is left to _pick_enumerated since it is the only
+    tolerance-dependent constraint.
+    """
+    serving_min = int(SERVING_MIN_BY_STEP[1.0])
+    ranges = [range(serving_min, int(s["max_serving"]) + 1) for s in all_subs]
+
+    n_combos = 1
+    for r in ranges:
+        n_combos *= len(r)
+        if n_combos > ENUMERATION_MAX_COMBOS:
+            return None
+
+    # Same coefficients as _build_lp
+    coefs = [
+        (
+            s["macros"]["protein"],
+            s["macros"]["carbs"],
+            s["macros"]["fat"],
+            s["macros"]["kcal"],
+            s["meal_type"],
+        )
+        for s in all_subs
+    ]
+    meal_types = {mt for *_, mt in coefs if mt}
+    rules = _meal_distribution_rules(meal_types)
+
+    safe_P = max(P_t, 1.0)
+    safe_C = max(C_t, 1.0)
+    safe_F = max(F_t, 1.0)
+    safe_K = max(kcal_t, 1.0)
+
+    candidates = []
+    for combo in itertools.product(*ranges):
+        tot_P = tot_C = tot_F = tot_K = 0
+        kcal_by_type = dict.fromkeys(meal_types, 0)
+        for u, (p, c, f, k, mt) in zip(combo, coefs):
+            tot_P += u * p
+            tot_C += u * c
+            tot_F += u * f
+            tot_K += u * k
+            if mt:
+                kcal_by_type[mt] += u * k
+
+        if not all(ok for rule in rules for ok in rule(kcal_by_type, tot_K)):
+            continue
+
+        objective = (
+            WEIGHT_PROTEIN   * abs(tot_P - P_t) / safe_P
+            + WEIGHT_CARBS   * abs(tot_C - C_t) / safe_C
+            + WEIGHT_FAT     * abs(tot_F - F_t) / safe_F
+            + WEIGHT_KCAL_SOFT * abs(tot_K - kcal_t) / safe_K
+        )
+        candidates.append((objective, tot_K, combo))
+
+    candidates.sort(key=lambda c: c[0])
+    return candidates
+
+
+def _pick_enumerated(
+    candidates: List[Tuple[float, float, Tuple[int, ...]]],
+    kcal_t: float,
+    tol: float,
+    allow_under_kcal: bool,
+) -> Tuple[float, Tuple[int, ...]] | None:
+    """
+    Best enumerated combination inside the +/- tol kcal band, or None.
+    Candidates are sorted by objective, so the first one in the band wins.
+    """
+    upper = (1.0 + tol) * kcal_t
+    lower = None if allow_under_kcal else (1.0 - tol) * kcal_t
+
+    for objective, tot_K, combo in candidates:
+        if tot_K > upper or (lower is not None and tot_K < lower):
+            continue
+        return objective, combo
+    return None
+
+
+# =============================================================================
+# SOLUTION CACHE
+# =============================================================================
+
+_solution_cache: Dict[Tuple, Tuple[List[Dict], float | None, Dict]] = {}
+
+
+def _problem_signature(
+    all_subs: List[Dict],
+    P_t: float,
+    C_t: float,
+    F_t: float,
+    kcal_t: float,
+    allow_under_kcal: bool,
+) -> Tuple:
+    """Hashable key covering every input that shapes the solver's output."""
+    subs_key = tuple(
+        (
+            s["meal"],
+            s["meal_type"],
+            s["subrecipe_id"],
+            s["name"],
+            s["macros"]["protein"],
+            s["macros"]["carbs"],
+            s["macros"]["fat"],
+            s["macros"]["kcal"],
+            s["max_serving"],
+        )
+        for s in all_subs
+    )
+    return subs_key, P_t, C_t, F_t, kcal_t, allow_under_kcal
+
+
+def _kcal_range(all_subs: List[Dict], serving_step: float) -> Tuple[float, float]:
+    """
+    Smallest and largest total_K the LP for this serving step can reach,
+    using the same kcal coefficients and serving bounds as _build_lp.
+    """
+    serving_min = SERVING_MIN_BY_STEP.get(serving_step, 1.0)
+    k_min = k_max = 0.0
+    for s in all_subs:
+        kcal = s["macros"]["kcal"]
+        max_units = int(round(float(s["max_serving"]) / serving_step))
+        lo = kcal * serving_min
+        hi = kcal * serving_step * max_units
+        k_min += min(lo, hi)
+        k_max += max(lo, hi)
+    return k_min, k_max
+
+
+def _solve_day(
+    all_subs: List[Dict],
+    P_t: float,
+    C_t: float,
+    F_t: float,
+    kcal_t: float,
+    allow_under_kcal: bool,
+) -> Tuple[Tuple[List[Dict], float | None, Dict], bool]:
+    """
+    Run the tolerance ladder, falling back to the greedy heuristic.
+    Returns (result, proven): proven is False when the answer depends on a
+    solve that CBC stopped early (time limit / gap) rather than finished.
+    """
+    # Guard: if all targets are zero we have nothing to optimise.
+    if kcal_t <= 0:
+        return _safe_fallback(
+            all_subs, P_t, C_t, F_t, kcal_t, allow_under_kcal
+        ), True
+
+    # Tolerance ladder: for each tolerance try integer step, then half-step.
+    # The half-step solve is warm-started from whatever values the failed
+    # integer solve left behind.
+    # One model per serving step is built lazily and re-solved with a
+    # shifted kcal band for each tolerance.
+    # Tolerances whose kcal band lies entirely outside the reachable
+    # [K_min, K_max] range are provably infeasible and skipped without
+    # calling CBC.
+    # Small integer-step grids are solved exactly by enumeration instead.
+    models: Dict[float, Dict[str, Any]] = {}
+    enumerated = _enumerate_integer_grid(all_subs, P_t, C_t, F_t, kcal_t)
+    kcal_ranges = {
+        step: _kcal_range(all_subs, step) for step in (1.0, SERVING_STEP_FINE)
+    }
+    proven = True
+    for tol in KCAL_TOLERANCES:
+        servings_hint: Dict[int, float] = {}
+        for step in (1.0, SERVING_STEP_FINE):
+            k_min, k_max = kcal_ranges[step]
+            if (1 + tol) * kcal_t < k_min - 1e-6:
+                continue
+            if not allow_under_kcal and (1 - tol) * kcal_t > k_max + 1e-6:
+                continue
+            if step == 1.0 and enumerated is not None:
+                best = _pick_enumerated(enumerated, kcal_t, tol, allow_under_kcal)
+                if best is not None:
+                    objective, combo = best
+                    return _solved_day_result(
+                        all_subs, [float(u) for u in combo], objective, tol, step
+                    ), True
+                continue
+            if step not in models:
+                models[step] = _build_lp(
+                    all_subs=all_subs,
+                    P_t=P_t,
+                    C_t=C_t,
+                    F_t=F_t,
+                    kcal_t=kcal_t,
+                    serving_step=step,
+                    allow_under_kcal=allow_under_kcal,
+                )
+            result = _solve_lp_once(
+                model=models[step],
+                all_subs=all_subs,
+                tol=tol,
+                warm_start=servings_hint if step != 1.0 else None,
+                servings_hint_out=servings_hint if step == 1.0 else None,
+            )
+            sol_status = models[step]["prob"].sol_status
+            if result is not None:
+                return result, sol_status == LpSolutionOptimal
+            if sol_status != LpSolutionInfeasible:
+                # Stopped without an incumbent: infeasibility is not proven
+                proven = False
+
+    # All LP attempts failed — use greedy safe fallback.
+    return _safe_fallback(
+        all_subs, P_t, C_t, F_t, kcal_t, allow_under_kcal
+    ), proven
+
+
 # =============================================================================
 # PUBLIC ENTRY POINT
 # =============================================================================
@@ -451,12 +862,17 @@ def optimize_subrecipes(
     # ------------------------------------------------------------------
     # 1. Flatten all subrecipes across meals
     # ------------------------------------------------------------------
+    subs_by_recipe = get_subrecipes_by_recipe(
+        [info["recipe_id"] for info in recipes_by_meal.values()]
+    )
+
     all_subs: List[Dict] = []
     for meal_key, info in recipes_by_meal.items():
-        subs = get_recipe_subrecipes(info["recipe_id"])
+        subs = subs_by_recipe.get(info["recipe_id"], [])
         for s in subs:
             all_subs.append({
                 "meal":         meal_key,
+                "meal_type":    info.get("meal_type"),
                 "subrecipe_id": s["id"],
                 "name":         s["name"],
                 "macros":       s["macros"],
@@ -477,34 +893,27 @@ def optimize_subrecipes(
     F_t     = float(macro_target.get("fat_g")     or 0.0)
     kcal_t  = float(macro_target.get("kcal")      or (4.0 * (P_t + C_t) + 9.0 * F_t))
 
-    # Guard: if all targets are zero we have nothing to optimise.
-    if kcal_t <= 0:
-        return _safe_fallback(
-            all_subs, recipes_by_meal, P_t, C_t, F_t, kcal_t, allow_under_kcal
-        )
-
-    # ------------------------------------------------------------------
-    # 3. Tolerance ladder: for each tolerance try integer step, then half-step.
-    # ------------------------------------------------------------------
-    for tol in KCAL_TOLERANCES:
-        for step in (1.0, SERVING_STEP_FINE):
-            result = _solve_lp_once(
-                all_subs=all_subs,
-                recipes_by_meal=recipes_by_meal,
-                P_t=P_t,
-                C_t=C_t,
-                F_t=F_t,
-                kcal_t=kcal_t,
-                serving_step=step,
-                tol=tol,
-                allow_under_kcal=allow_under_kcal,
-            )
-            if result is not None:
-                return result
-
     # ------------------------------------------------------------------
-    # 4. All LP attempts failed — use greedy safe fallback.
+    # 3. Solve (or reuse an identical, previously solved day).
+    #    Results are deep-copied so callers can mutate them freely; only
+    #    proven results are cached.
     # ------------------------------------------------------------------
-    return _safe_fallback(
-        all_subs, recipes_by_meal, P_t, C_t, F_t, kcal_t, allow_under_kcal
+    cache_key = _problem_signature(
+        all_subs, P_t, C_t, F_t, kcal_t, allow_under_kcal
     )
+    cached = _solution_cache.pop(cache_key, None)
+    if cached is not None:
+        # Re-insert to mark as most recently used
+        _solution_cache[cache_key] = cached
+        return copy.deepcopy(cached)
+
+    result, proven = _solve_day(
+        all_subs, P_t, C_t, F_t, kcal_t, allow_under_kcal
+    )
+
+    if proven:
+        _solution_cache[cache_key] = copy.deepcopy(result)
+        while len(_solution_cache) > SOLUTION_CACHE_MAX_ENTRIES:
+            _solution_cache.pop(next(iter(_solution_cache)))
+
+    return result
@@ -1,7 +1,8 @@
 from datetime import datetime
 from typing import Dict, Any, List, Tuple
 from collections import defaultdict
-import copy
+from operator import itemgetter
+import time
 
 from utils.supabase_client import supabase
 from services.mealplan_service import optimize_subrecipes
@@ -30,16 +31,27 @@ def consolidate_changes(change_logs: List[Dict[str, Any]]) -> Dict[str, Any]:
         }
       }
     """
-    # Normalize created_at to datetime
+    # Normalize created_at to datetime (one pass; already-parsed values
+    # from a previous call are left alone). Logs written together share a
+    # timestamp, so each distinct string is parsed once.
+    parse = datetime.fromisoformat
+    parsed: Dict[str, datetime] = {}
     for log in change_logs:
-        if isinstance(log.get("created_at"), str):
-            # strip trailing Z if present
-            log["created_at"] = datetime.fromisoformat(
-                log["created_at"].replace("Z", "")
-            )
-
-    # Sort logs chronologically
-    change_logs.sort(key=lambda x: x["created_at"])
+        created_at = log.get("created_at")
+        if isinstance(created_at, str):
+            dt = parsed.get(created_at)
+            if dt is None:
+                # strip trailing Z if present (fromisoformat would accept it,
+                # but return an aware datetime that can't be compared with
+                # the naive ones already parsed)
+                text = created_at[:-1] if created_at.endswith("Z") else created_at
+                dt = parsed[created_at] = parse(text)
+            log["created_at"] = dt
+
+    # Sort logs chronologically. This is the only sort: grouping by date and
+    # then by meal_key below preserves this order, so every group's last
+    # entry is its latest log.
+    change_logs.sort(key=itemgetter("created_at"))
 
     # Group by date
     grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
@@ -49,25 +61,26 @@ def consolidate_changes(change_logs: List[Dict[str, Any]]) -> Dict[str, Any]:
     final_state: Dict[str, Any] = {}
 
     for date, entries in grouped.items():
-        # Check if the entire day has been deleted (no meal_key on log)
-        deleted_day_entry = next(
-            (e for e in reversed(entries) if e.get("Delete") and not e.get("meal_key")),
-            None
-        )
-        if deleted_day_entry:
-            final_state[date] = {"deleted_day": True}
-            continue
-
-        # Group by meal_key for this day
+        # One scan: group by meal_key for this day, stopping as soon as the
+        # entire day turns out to be deleted (Delete log with no meal_key)
+        deleted_day = False
         meals_by_key: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
         for e in entries:
-            if e.get("meal_key"):
-                meals_by_key[e["meal_key"]].append(e)
+            meal_key = e.get("meal_key")
+            if meal_key:
+                meals_by_key[meal_key].append(e)
+            elif e.get("Delete"):
+                deleted_day = True
+                break
+
+        if deleted_day:
+            final_state[date] = {"deleted_day": True}
+            continue
 
         day_actions: Dict[str, Any] = {}
         for meal_key, logs in meals_by_key.items():
-            # Take the last log for that meal_key
-            last_log = sorted(logs, key=lambda x: x["created_at"])[-1]
+            # Take the last log for that meal_key (already chronological)
+            last_log = logs[-1]
 
             if last_log.get("Delete"):
                 day_actions[meal_key] = {
@@ -96,54 +109,68 @@ def consolidate_changes(change_logs: List[Dict[str, Any]]) -> Dict[str, Any]:
 # ------------------------------------------------------------------
 # STEP 2. Fetch recipe + subrecipes/macros from Supabase
 # ------------------------------------------------------------------
-def fetch_recipe_details(recipe_id: int) -> Dict[str, Any]:
-    """
-    Fetch a recipe and its subrecipes/macros from Supabase and return
-    data in a format compatible with the meal plan structure.
-    """
-    resp = (
-        supabase.table("recipe")
-        .select(
-            "id, name, photo, "
-            "could_be_breakfast, could_be_lunch, could_be_dinner, could_be_snack, "
-            "recipe_subrecipe(subrecipe(id, name, kcal, protein, carbs, fat, max_serving))"
-        )
-        .eq("id", recipe_id)
-        .single()
-        .execute()
-    )
-
-    recipe = resp.data
-    if not recipe:
-        return {}
-
+# Process-level cache of raw recipe rows. The same replacement recipe is
+# often picked on several days and across updates; the TTL bounds how long
+# an admin edit can take to show up (clear_recipe_details_cache() drops it
+# immediately). Rows are cached, not shaped details, so every caller gets
+# fresh dicts it can mutate.
+RECIPE_DETAILS_CACHE_TTL_SECONDS = 300
+RECIPE_DETAILS_CACHE_MAX_RECIPES = 1024
+
+_recipe_row_cache: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+
+
+def clear_recipe_details_cache(recipe_id: int | None = None) -> None:
+    """Drop one recipe's cached row, or every entry when recipe_id is None."""
+    if recipe_id is None:
+        _recipe_row_cache.clear()
+    else:
+        _recipe_row_cache.pop(recipe_id, None)
+
+
+RECIPE_DETAILS_SELECT = (
+    "id, name, photo, "
+    "could_be_breakfast, could_be_lunch, could_be_dinner, could_be_snack, "
+    "recipe_subrecipe(subrecipe(id, name, kcal, protein, carbs, fat, max_serving))"
+)
+
+# (meal_type, recipe flag column), in the order meal_types are reported
+_MEAL_FLAGS = (
+    ("breakfast", "could_be_breakfast"),
+    ("lunch", "could_be_lunch"),
+    ("dinner", "could_be_dinner"),
+    ("snack", "could_be_snack"),
+)
+
+
+def _recipe_details_from_row(recipe: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape a `recipe` row (with embedded subrecipes) into meal plan format."""
     subrecipes = []
-    total_macros = {"protein": 0.0, "carbs": 0.0, "fat": 0.0, "kcal": 0.0}
+    total_protein = total_carbs = total_fat = total_kcal = 0.0
 
     for rs in recipe.get("recipe_subrecipe", []):
         s = rs.get("subrecipe", {}) or {}
-        macros = {
-            "protein": s.get("protein") or 0.0,
-            "carbs": s.get("carbs") or 0.0,
-            "fat": s.get("fat") or 0.0,
-            "kcal": s.get("kcal") or 0.0,
-        }
+        protein, carbs, fat, kcal = (
+            s.get("protein") or 0.0,
+            s.get("carbs") or 0.0,
+            s.get("fat") or 0.0,
+            s.get("kcal") or 0.0,
+        )
         subrecipes.append(
             {
                 "subrecipe_id": s.get("id"),
                 "name": s.get("name"),
                 "servings": 1,
-                "macros": macros,
+                "macros": {"protein": protein, "carbs": carbs, "fat": fat, "kcal": kcal},
             }
         )
-        for k in total_macros:
-            total_macros[k] += macros[k]
+        total_protein += protein
+        total_carbs += carbs
+        total_fat += fat
+        total_kcal += kcal
 
     # Guess meal types based on boolean flags on the recipe
-    meal_types: List[str] = []
-    for t in ["breakfast", "lunch", "dinner", "snack"]:
-        if recipe.get(f"could_be_{t}"):
-            meal_types.append(t)
+    meal_types: List[str] = [name for name, col in _MEAL_FLAGS if recipe.get(col)]
 
     return {
         "recipe_id": recipe["id"],
@@ -151,13 +178,81 @@ def fetch_recipe_details(recipe_id: int) -> Dict[str, Any]:
         "photo": recipe.get("photo"),
         "meal_types": meal_types,
         "subrecipes": subrecipes,
-        "macros": {k: round(v) for k, v in total_macros.items()},
+        "macros": {
+            "protein": round(total_protein),
+            "carbs": round(total_carbs),
+            "fat": round(total_fat),
+            "kcal": round(total_kcal),
+        },
     }
 
 
+def _parse_recipe_id(value: Any) -> int:
+    """
+    Recipe ids arrive in request JSON and may be numeric strings; results
+    and the cache are keyed by the table's int id.
+    Raises ValueError for anything that isn't an integer id.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid recipe id: {value!r}")
+
+
+def fetch_recipe_details(recipe_id: int) -> Dict[str, Any]:
+    """
+    Fetch a recipe and its subrecipes/macros from Supabase and return
+    data in a format compatible with the meal plan structure.
+    """
+    recipe_id = _parse_recipe_id(recipe_id)
+    return fetch_recipe_details_bulk([recipe_id]).get(recipe_id, {})
+
+
+def fetch_recipe_details_bulk(recipe_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    """
+    Batched fetch_recipe_details: one round trip for all recipe_ids that
+    are not already in the process cache.
+    Returns { recipe_id: details } keyed by int id; ids that don't exist
+    are absent. Raises ValueError for ids that aren't integers.
+    """
+    now = time.monotonic()
+    rows: Dict[int, Dict[str, Any]] = {}
+    missing: List[int] = []
+
+    for rid in {_parse_recipe_id(rid) for rid in recipe_ids}:
+        hit = _recipe_row_cache.pop(rid, None)
+        if hit and now - hit[0] < RECIPE_DETAILS_CACHE_TTL_SECONDS:
+            # Re-insert to mark as most recently used
+            _recipe_row_cache[rid] = hit
+            rows[rid] = hit[1]
+        else:
+            missing.append(rid)
+
+    if missing:
+        resp = (
+            supabase.table("recipe")
+            .select(RECIPE_DETAILS_SELECT)
+            .in_("id", missing)
+            .execute()
+        )
+        for recipe in resp.data or []:
+            _recipe_row_cache[recipe["id"]] = (now, recipe)
+            rows[recipe["id"]] = recipe
+
+        # Evict least recently used entries (dict keeps insertion order)
+        while len(_recipe_row_cache) > RECIPE_DETAILS_CACHE_MAX_RECIPES:
+            _recipe_row_cache.pop(next(iter(_recipe_row_cache)))
+
+    return {rid: _recipe_details_from_row(recipe) for rid, recipe in rows.items()}
+
+
 # ------------------------------------------------------------------
 # STEP 3. Apply user changes + re-optimize macros dynamically
 # ------------------------------------------------------------------
+# Target keys scaled down when a meal is eaten out (kcal is handled alongside)
+_MACRO_KEYS = ("protein_g", "carbs_g", "fat_g")
+
+
 def apply_changes_and_optimize(
     current_plan: Dict[str, Any],
     changes: Dict[str, Any],
@@ -173,23 +268,44 @@ def apply_changes_and_optimize(
       - Subsequent updates (on other days) will still keep this reduced
         target instead of going back to the global daily target.
     """
-    updated_plan = copy.deepcopy(current_plan)
+    # Only the containers that change are copied: the plan itself, and the
+    # meals of days being re-optimized (which get new recipes/subrecipes).
+    # Unchanged days are carried over by reference; nothing in current_plan
+    # is mutated.
+    updated_plan = dict(current_plan)
 
     # Global target defined at the root of the plan from /generate_meal_plan
     global_daily_target: Dict[str, Any] = updated_plan.get("daily_macro_target", {}) or {}
     new_days: List[Dict[str, Any]] = []
 
+    # Split consolidated changes once: whole-day deletions vs per-meal changes
+    deleted_dates = {d for d, c in changes.items() if c.get("deleted_day")}
+    meal_changes: Dict[str, Dict[str, Any]] = {
+        d: c for d, c in changes.items() if d not in deleted_dates
+    }
+
+    # Fetch every replacement recipe up front in a single query
+    # (ids are normalized to int here, so a malformed id fails the request
+    # before anything is optimized instead of silently leaving a meal as-is)
+    replacement_ids = [
+        _parse_recipe_id(change["new_recipe_id"])
+        for day_changes in meal_changes.values()
+        for change in day_changes.values()
+        if change.get("action") == "replace"
+    ]
+    recipe_details = fetch_recipe_details_bulk(replacement_ids)
+
     for day in updated_plan.get("days", []):
         date = day["date"]
-        day_change = changes.get(date)
 
         # 1. Skip days explicitly deleted
-        if day_change and day_change.get("deleted_day"):
+        if date in deleted_dates:
             continue
         # ✅ NEW: If this day has no change logs, keep it intact (no re-optimization)
-        if not day_change:
+        changes_for_day = meal_changes.get(date)
+        if not changes_for_day:
             new_days.append(day)
-            continue    
+            continue
         # 2. Determine baseline target for this specific day
         #    If the day was adjusted previously, re-use that. Otherwise,
         #    fall back to the global daily target.
@@ -198,12 +314,14 @@ def apply_changes_and_optimize(
         updated_meals: List[Dict[str, Any]] = []
         deleted_meal_types_for_day = set()
         reduce_macros_pct = 0.0  # cumulative % reduction of daily macros
+        day_changed = False  # did any change actually apply to this day's meals?
 
         # 3. Apply meal-level changes (replace/delete) and track reductions
         for meal in day.get("meals", []):
+            meal = dict(meal)
             meal_key = meal["meal_key"]
             meal_type = meal["meal_type"]
-            change = (day_change or {}).get(meal_key)
+            change = changes_for_day.get(meal_key)
 
             if not change:
                 # No change for this meal
@@ -214,14 +332,15 @@ def apply_changes_and_optimize(
 
             # --- Replace recipe ---
             if action == "replace":
-                new_recipe_id = change["new_recipe_id"]
-                new_recipe = fetch_recipe_details(new_recipe_id)
+                new_recipe_id = _parse_recipe_id(change["new_recipe_id"])
+                new_recipe = recipe_details.get(new_recipe_id)
                 if not new_recipe:
                     # If for some reason the new recipe can't be fetched,
                     # keep the original meal as-is
                     updated_meals.append(meal)
                     continue
 
+                day_changed = True
                 meal.update(
                     {
                         "recipe_id": new_recipe["recipe_id"],
@@ -236,6 +355,7 @@ def apply_changes_and_optimize(
 
             # --- Delete recipe ---
             if action == "delete":
+                day_changed = True
                 include_macros = change.get("include_macros_in_rest", True)
                 deleted_meal_types_for_day.add(meal_type)
 
@@ -255,24 +375,33 @@ def apply_changes_and_optimize(
                     # We still drop the meal entirely from the day
                     continue
 
+        # Changes only named meal_keys this day doesn't have, or every
+        # replacement failed to load → keep the day intact (no re-optimization)
+        if not day_changed:
+            new_days.append(day)
+            continue
+
         # 4. If all meal types of the day were deleted → drop the entire day
         #    (we consider there are 4 possible meal types in the system)
         if len(deleted_meal_types_for_day) >= 4:
             continue
 
         # 5. Adjust macro target based on reduced percentage
-        adjusted_target = copy.deepcopy(baseline_target)
+        # Targets are flat scalars (protein_g, carbs_g, fat_g, kcal)
+        adjusted_target = dict(baseline_target)
 
         if reduce_macros_pct > 0:
-            pct = min(reduce_macros_pct, 1.0)
+            factor = 1 - min(reduce_macros_pct, 1.0)
 
-            for key in ["protein_g", "carbs_g", "fat_g"]:
-                if adjusted_target.get(key) is not None:
-                    adjusted_target[key] = round(adjusted_target[key] * (1 - pct), 2)
+            for key in _MACRO_KEYS:
+                v = adjusted_target.get(key)
+                if v is not None:
+                    adjusted_target[key] = round(v * factor, 2)
 
             # 🔴 THIS WAS MISSING
-            if adjusted_target.get("kcal") is not None:
-                adjusted_target["kcal"] = round(adjusted_target["kcal"] * (1 - pct), 2)
+            kcal = adjusted_target.get("kcal")
+            if kcal is not None:
+                adjusted_target["kcal"] = round(kcal * factor, 2)
 
 
         # 6. Prepare recipes_by_meal for optimization
@@ -319,10 +448,13 @@ def apply_changes_and_optimize(
             if not sub_list:
                 continue
 
-            total_protein = sum(s["macros"]["protein"] for s in sub_list)
-            total_carbs = sum(s["macros"]["carbs"] for s in sub_list)
-            total_fat = sum(s["macros"]["fat"] for s in sub_list)
-            total_kcal = sum(s["macros"]["kcal"] for s in sub_list)
+            total_protein = total_carbs = total_fat = total_kcal = 0
+            for s in sub_list:
+                m = s["macros"]
+                total_protein += m["protein"]
+                total_carbs += m["carbs"]
+                total_fat += m["fat"]
+                total_kcal += m["kcal"]
 
             meal["macros"] = {
                 "protein": round(total_protein),
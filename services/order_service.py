@@ -1,10 +1,19 @@
 # services/order_service.py
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
 from utils.supabase_client import supabase
 from datetime import datetime, timedelta
 
 DEFAULT_MAX_DELIVERIES = 20
 
+# Shared pool for Supabase calls that don't depend on each other: the
+# partner read, and confirm_order's slot preparation (which also inserts any
+# missing delivery_slots_daily rows). Tasks submitted here must not wait on
+# other tasks in the pool, so a burst of orders can't deadlock it.
+_io_pool = ThreadPoolExecutor(max_workers=8)
+
 
 class OrderService:
     def __init__(self):
@@ -31,32 +40,22 @@ class OrderService:
         if not meal_days:
             return {"error": "No meal days found in meal plan."}, 400
 
-        # 2) determine if the slot is AM or PM based on start_time in delivery_slots
+        # one timestamp for every row written by this order
+        now = datetime.utcnow().isoformat()
+
+        # 2)-4) slot lookups run on the I/O pool while this thread reads the
+        #       user's address + partner (step 6). Results are checked in the
+        #       original order, so error responses are unchanged.
+        slot_future = _io_pool.submit(
+            self._prepare_delivery_days, meal_days, delivery_slot_id, now
+        )
+        user_info = self._fetch_user_delivery_and_partner(user_id)
+
         try:
-            slot_period = self._get_slot_period(delivery_slot_id)  # "AM" or "PM"
+            delivery_days, meal_to_delivery, full_days, slot_day_map = slot_future.result()
         except ValueError as e:
             return {"error": str(e)}, 400
 
-        # 3) map meal_day -> delivery_day according to your business logic:
-        #    - AM slot: deliver on the same calendar day as the meal
-        #    - PM slot: deliver the previous calendar day (evening before)
-        delivery_days = []
-        meal_to_delivery = {}
-
-        for meal_day_str in meal_days:
-            meal_date = datetime.strptime(meal_day_str, "%Y-%m-%d").date()
-
-            if slot_period == "AM":
-                delivery_date = meal_date
-            else:  # "PM"
-                delivery_date = meal_date - timedelta(days=1)
-
-            delivery_str = delivery_date.isoformat()
-            delivery_days.append(delivery_str)
-            meal_to_delivery[meal_day_str] = delivery_str
-
-        # 4) capacity checks (bulk) on DELIVERY days + ensure rows exist; also return slot_day_map
-        full_days, slot_day_map = self._check_and_prepare_slot_days(delivery_days, delivery_slot_id)
         if len(full_days) > 2:
             return {
                 "error": "Too many selected delivery days are fully booked. Please change your slot.",
@@ -64,10 +63,9 @@ class OrderService:
             }, 400
 
         # 5) upsert preference
-        self._upsert_user_delivery_preference(user_id, delivery_slot_id)
+        self._upsert_user_delivery_preference(user_id, delivery_slot_id, now)
 
-        # 6) user info + partner
-        user_info = self._fetch_user_delivery_and_partner(user_id)
+        # 6) user info + partner (fetched above)
         if not user_info or not user_info.get("delivery_address"):
             return {"error": "User delivery address not found."}, 400
 
@@ -81,6 +79,7 @@ class OrderService:
             delivery_slot_id=delivery_slot_id,
             delivery_address=delivery_address,
             slot_day_map=slot_day_map,
+            now=now,
         )
 
         # 8) persist meal plan bundle & get mapping meal_date -> meal_plan_day_id
@@ -89,6 +88,7 @@ class OrderService:
             meal_plan=meal_plan,
             deliveries_map=deliveries_map,   # keyed by delivery_date
             meal_to_delivery=meal_to_delivery,  # meal_date -> delivery_date
+            now=now,
         )
 
         # 9) payment (unchanged: uses meal days)
@@ -97,6 +97,7 @@ class OrderService:
             partner_id=partner_id,
             checkout_summary=checkout_summary,
             day_to_meal_plan_day_id=day_to_meal_plan_day_id,
+            now=now,
         )
         # Save promo_code_usage if promo was valid
         price_info = checkout_summary.get("price_breakdown", {})
@@ -143,9 +144,43 @@ class OrderService:
 
         return "AM" if hour < 12 else "PM"
 
+    def _prepare_delivery_days(self, meal_days, delivery_slot_id, now):
+        """
+        Steps 2-4 of confirm_order, run as one task on the I/O pool.
+        Raises ValueError if the slot can't be resolved.
+        Returns (delivery_days, meal_to_delivery, full_days, slot_day_map).
+        """
+        # 2) determine if the slot is AM or PM based on start_time in delivery_slots
+        slot_period = self._get_slot_period(delivery_slot_id)  # "AM" or "PM"
+
+        # 3) map meal_day -> delivery_day according to your business logic:
+        #    - AM slot: deliver on the same calendar day as the meal
+        #    - PM slot: deliver the previous calendar day (evening before)
+        delivery_days = []
+        meal_to_delivery = {}
+
+        for meal_day_str in meal_days:
+            meal_date = datetime.strptime(meal_day_str, "%Y-%m-%d").date()
+
+            if slot_period == "AM":
+                delivery_date = meal_date
+            else:  # "PM"
+                delivery_date = meal_date - timedelta(days=1)
+
+            delivery_str = delivery_date.isoformat()
+            delivery_days.append(delivery_str)
+            meal_to_delivery[meal_day_str] = delivery_str
+
+        # 4) capacity checks (bulk) on DELIVERY days + ensure rows exist; also return slot_day_map
+        full_days, slot_day_map = self._check_and_prepare_slot_days(
+            delivery_days, delivery_slot_id, now
+        )
+
+        return delivery_days, meal_to_delivery, full_days, slot_day_map
+
     # ---------- HELPERS ----------
 
-    def _check_and_prepare_slot_days(self, delivery_days, delivery_slot_id):
+    def _check_and_prepare_slot_days(self, delivery_days, delivery_slot_id, now):
         """
         Bulk version:
         - Fetch existing delivery_slots_daily rows for all delivery_days.
@@ -169,7 +204,6 @@ class OrderService:
 
         # Insert missing rows in batch
         if missing_days:
-            now = datetime.utcnow().isoformat()
             insert_payload = [
                 {
                     "delivery_slot_id": delivery_slot_id,
@@ -201,7 +235,7 @@ class OrderService:
 
         return full_days, slot_day_map
 
-    def _upsert_user_delivery_preference(self, user_id, delivery_slot_id):
+    def _upsert_user_delivery_preference(self, user_id, delivery_slot_id, now):
         """
         Keep safe logic: select then update/insert.
         This is called rarely, so performance impact is small.
@@ -213,8 +247,6 @@ class OrderService:
             .execute()
         )
 
-        now = datetime.utcnow().isoformat()
-
         if res.data:
             pref = res.data[0]
             if pref.get("delivery_slot_id") != delivery_slot_id:
@@ -237,26 +269,29 @@ class OrderService:
         """
         delivery_address from user.
         partner via partner_client_link (latest/active row if multiple).
+        The partner SELECT runs on the I/O pool alongside the user SELECT.
         """
+        partner_future = _io_pool.submit(
+            self.sb.table("partner_client_link")
+            .select("partner_id, start_date")
+            .eq("client_id", user_id)
+            .order("start_date", desc=True)  # latest if multiple
+            .limit(1)
+            .execute
+        )
+
         user_res = (
             self.sb.table("user")
             .select("delivery_address")
             .eq("id", user_id)
             .execute()
         )
+        partner_res = partner_future.result()
         if not user_res.data:
             return None
 
         delivery_address = user_res.data[0].get("delivery_address")
 
-        partner_res = (
-            self.sb.table("partner_client_link")
-            .select("partner_id, start_date")
-            .eq("client_id", user_id)
-            .order("start_date", desc=True)  # latest if multiple
-            .limit(1)
-            .execute()
-        )
         partner_id = partner_res.data[0]["partner_id"] if partner_res.data else None
 
         return {
@@ -271,16 +306,16 @@ class OrderService:
         delivery_slot_id,
         delivery_address,
         slot_day_map,
+        now,
     ):
         """
-        For each DELIVERY day:
-          - increment current_count in delivery_slots_daily (no extra SELECTs)
-          - insert deliveries row
+        For each DELIVERY day, one UPDATE of current_count/updated_at in
+        delivery_slots_daily (no extra SELECTs). The new count comes from the
+        slot_day_map rows read earlier, so it is not an atomic increment:
+        concurrent orders on the same slot day can still lose an increment.
+        Only the deliveries rows are batched, into a single insert.
         Return {delivery_date: delivery_id}
         """
-        deliveries_map = {}
-        now = datetime.utcnow().isoformat()
-
         for day in delivery_days:
             slot_day = slot_day_map.get(day)
 
@@ -300,27 +335,32 @@ class OrderService:
                     .eq("id", slot_day["id"])
                     .execute()
                 )
-            else:
-                # Extremely rare because we created missing rows earlier
-                ins = (
-                    self.sb.table("delivery_slots_daily")
-                    .insert(
-                        {
-                            "delivery_slot_id": delivery_slot_id,
-                            "delivery_date": day,
-                            "current_count": 1,
-                            "max_deliveries": DEFAULT_MAX_DELIVERIES,
-                            "created_at": now,
-                        }
-                    )
-                    .execute()
-                )
-                slot_day = ins.data[0] if ins.data else None
 
-            # insert delivery
-            delivery_ins = (
-                self.sb.table("deliveries")
-                .insert(
+        # Extremely rare because we created missing rows earlier
+        missing_slot_rows = [
+            {
+                "delivery_slot_id": delivery_slot_id,
+                "delivery_date": day,
+                "current_count": 1,
+                "max_deliveries": DEFAULT_MAX_DELIVERIES,
+                "created_at": now,
+            }
+            for day in delivery_days
+            if not slot_day_map.get(day)
+        ]
+
+        if missing_slot_rows:
+            (
+                self.sb.table("delivery_slots_daily")
+                .insert(missing_slot_rows)
+                .execute()
+            )
+
+        # insert deliveries
+        delivery_ins = (
+            self.sb.table("deliveries")
+            .insert(
+                [
                     {
                         "user_id": user_id,
                         "delivery_date": day,
@@ -329,24 +369,27 @@ class OrderService:
                         "status": "pending",
                         "created_at": now,
                     }
-                )
-                .execute()
+                    for day in delivery_days
+                ]
             )
+            .execute()
+        )
 
-            delivery_id = delivery_ins.data[0]["id"]
-            deliveries_map[day] = delivery_id
+        deliveries_map = {row["delivery_date"]: row["id"] for row in delivery_ins.data}
 
         return deliveries_map
 
-    def _store_meal_plan_bundle(self, user_id, meal_plan, deliveries_map, meal_to_delivery):
+    def _store_meal_plan_bundle(
+        self, user_id, meal_plan, deliveries_map, meal_to_delivery, now
+    ):
         """
         Insert meal_plan, per-day rows (with status + correct delivery_id),
         update deliveries.meal_plan_day_id, then recipes & subrecipes.
+        Inserts are one bulk call per table; the two link columns are set
+        with one UPDATE per day.
         Returns:
           day_to_meal_plan_day_id: {meal_date_str: meal_plan_day_id}
         """
-        now = datetime.utcnow().isoformat()
-
         # meal_plan
         plan_ins = (
             self.sb.table("meal_plan")
@@ -362,65 +405,78 @@ class OrderService:
         )
         plan_id = plan_ins.data[0]["id"]
 
-        day_to_meal_plan_day_id = {}
+        days = meal_plan.get("days") or []
 
-        for day in (meal_plan.get("days") or []):
+        # 1️⃣ Create all meal_plan_day rows in one call
+        day_rows = []
+        for day in days:
             meal_date_str = day["date"]
-            totals = day.get("totals") or {}
 
             # find the delivery date for this meal_date, then the delivery_id
             delivery_date_str = meal_to_delivery.get(meal_date_str)
             delivery_id = deliveries_map.get(delivery_date_str) if delivery_date_str else None
 
-            # 1️⃣ Create meal_plan_day
-            day_ins = (
-                self.sb.table("meal_plan_day")
-                .insert(
-                    {
-                        "meal_plan_id": plan_id,
-                        "date": meal_date_str,
-                        "delivery_id": delivery_id,
-                        "status": "pending",  # assuming this column still exists
-                        "created_at": now,
-                    }
-                )
-                .execute()
+            day_rows.append(
+                {
+                    "meal_plan_id": plan_id,
+                    "date": meal_date_str,
+                    "delivery_id": delivery_id,
+                    "status": "pending",  # assuming this column still exists
+                    "created_at": now,
+                }
             )
-            meal_plan_day_id = day_ins.data[0]["id"]
-            day_to_meal_plan_day_id[meal_date_str] = meal_plan_day_id
 
-            # 2️⃣ Create daily_macro_order
-            daily_macro_ins = (
-                self.sb.table("daily_macro_order")
-                .insert(
-                    {
-                        "user_id": user_id,
-                        "meal_plan_day_id": meal_plan_day_id,
-                        "for_date": meal_date_str,
-                        "protein_ordered": totals.get("protein"),
-                        "carbs_ordered": totals.get("carbs"),
-                        "fat_ordered": totals.get("fat"),
-                        "kcal_ordered": totals.get("kcal"),
-                        "saturated_fat_ordered": (
-                            totals.get("saturated")
-                            if "saturated" in totals
-                            else None
-                        ),
-                        "fiber_ordered": totals.get("fiber"),
-                        "sugar_ordered": totals.get("sugar"),
-                        "created_at": now,
-                    }
-                )
-                .execute()
+        if not day_rows:
+            return {}
+
+        day_ins = self.sb.table("meal_plan_day").insert(day_rows).execute()
+
+        # map returned rows back to plan days by date, not by position
+        day_row_by_date = {row["date"]: row for row in day_ins.data}
+        missing_dates = [day["date"] for day in days if day["date"] not in day_row_by_date]
+        if missing_dates:
+            raise ValueError(f"meal_plan_day insert returned no row for {missing_dates}")
+
+        day_to_meal_plan_day_id = {date: row["id"] for date, row in day_row_by_date.items()}
+
+        # 2️⃣ Create all daily_macro_order rows in one call
+        macro_rows = []
+        for day in days:
+            day_row = day_row_by_date[day["date"]]
+            totals = day.get("totals") or {}
+            macro_rows.append(
+                {
+                    "user_id": user_id,
+                    "meal_plan_day_id": day_row["id"],
+                    "for_date": day["date"],
+                    "protein_ordered": totals.get("protein"),
+                    "carbs_ordered": totals.get("carbs"),
+                    "fat_ordered": totals.get("fat"),
+                    "kcal_ordered": totals.get("kcal"),
+                    "saturated_fat_ordered": (
+                        totals.get("saturated")
+                        if "saturated" in totals
+                        else None
+                    ),
+                    "fiber_ordered": totals.get("fiber"),
+                    "sugar_ordered": totals.get("sugar"),
+                    "created_at": now,
+                }
             )
-            daily_macro_order_id = daily_macro_ins.data[0]["id"]
 
-            # 3️⃣ Update meal_plan_day to include daily_macro_order_id
+        macro_ins = self.sb.table("daily_macro_order").insert(macro_rows).execute()
+        macro_id_by_day = {row["meal_plan_day_id"]: row["id"] for row in macro_ins.data}
+
+        # 3️⃣ + 4️⃣ Per day: link meal_plan_day -> daily_macro_order, and
+        #    back-link deliveries -> meal_plan_day. Plain UPDATEs that write
+        #    only the changed columns (no full-row upserts).
+        for day in days:
+            meal_plan_day_id = day_row_by_date[day["date"]]["id"]
             (
                 self.sb.table("meal_plan_day")
                 .update(
                     {
-                        "daily_macro_order_id": daily_macro_order_id,
+                        "daily_macro_order_id": macro_id_by_day.get(meal_plan_day_id),
                         "updated_at": now,
                     }
                 )
@@ -428,7 +484,8 @@ class OrderService:
                 .execute()
             )
 
-            # 4️⃣ Back-link on deliveries (delivery -> meal_plan_day)
+            delivery_date_str = meal_to_delivery.get(day["date"])
+            delivery_id = deliveries_map.get(delivery_date_str) if delivery_date_str else None
             if delivery_id:
                 (
                     self.sb.table("deliveries")
@@ -442,44 +499,67 @@ class OrderService:
                     .execute()
                 )
 
-            # 5️⃣ Recipes + subrecipes
+        # 5️⃣ Recipes (one insert across all days) + subrecipes (one insert)
+        meals_flat = []
+        rec_rows = []
+        for day in days:
+            day_row = day_row_by_date[day["date"]]
             for meal in (day.get("meals") or []):
-                rec_ins = (
-                    self.sb.table("meal_plan_day_recipe")
-                    .insert(
-                        {
-                            "meal_plan_day_id": meal_plan_day_id,
-                            "recipe_id": meal["recipe_id"],
-                            "meal_type": meal.get("meal_type"),
-                            "cooking_status": "pending",    # updated schema
-                            "packaging_status": "pending",  # updated schema
-                            "created_at": now,
-                        }
-                    )
-                    .execute()
+                meals_flat.append(meal)
+                rec_rows.append(
+                    {
+                        "meal_plan_day_id": day_row["id"],
+                        # int, to match the ids the insert returns
+                        "recipe_id": int(meal["recipe_id"]),
+                        "meal_type": meal.get("meal_type"),
+                        "cooking_status": "pending",    # updated schema
+                        "packaging_status": "pending",  # updated schema
+                        "created_at": now,
+                    }
                 )
-                mpdr_id = rec_ins.data[0]["id"]
-
-                for sub in (meal.get("subrecipes") or []):
-                    sub_macros = sub.get("macros") or {}
-                    (
-                        self.sb.table("meal_plan_day_recipe_serving")
-                        .insert(
-                            {
-                                "meal_plan_day_recipe_id": mpdr_id,
-                                "subrecipe_id": sub["subrecipe_id"],
-                                "recipe_subrecipe_serving_calculated": sub.get("servings"),
-                                "kcal_calculated": sub_macros.get("kcal"),
-                                "protein_calculated": sub_macros.get("protein"),
-                                "carbs_calculated": sub_macros.get("carbs"),
-                                "fat_calculated": sub_macros.get("fat"),
-                                "cooking_status": "pending",     # per-serving cooking
-                                "portioning_status": "pending",  # per-serving portioning
-                                "created_at": now,
-                            }
-                        )
-                        .execute()
-                    )
+
+        if not rec_rows:
+            return day_to_meal_plan_day_id
+
+        rec_ins = self.sb.table("meal_plan_day_recipe").insert(rec_rows).execute()
+        if len(rec_ins.data) != len(rec_rows):
+            raise ValueError("meal_plan_day_recipe insert returned an unexpected number of rows")
+
+        # map returned ids back to meals by (day, recipe, meal_type), not by position
+        rec_ids_by_key = defaultdict(list)
+        for row in rec_ins.data:
+            rec_ids_by_key[(row["meal_plan_day_id"], row["recipe_id"], row["meal_type"])].append(row["id"])
+
+        serving_rows = []
+        for meal, rec_row in zip(meals_flat, rec_rows):
+            key = (rec_row["meal_plan_day_id"], rec_row["recipe_id"], rec_row["meal_type"])
+            if not rec_ids_by_key.get(key):
+                raise ValueError(f"meal_plan_day_recipe insert returned no row for {key}")
+            mpdr_id = rec_ids_by_key[key].pop(0)
+
+            for sub in (meal.get("subrecipes") or []):
+                sub_macros = sub.get("macros") or {}
+                serving_rows.append(
+                    {
+                        "meal_plan_day_recipe_id": mpdr_id,
+                        "subrecipe_id": sub["subrecipe_id"],
+                        "recipe_subrecipe_serving_calculated": sub.get("servings"),
+                        "kcal_calculated": sub_macros.get("kcal"),
+                        "protein_calculated": sub_macros.get("protein"),
+                        "carbs_calculated": sub_macros.get("carbs"),
+                        "fat_calculated": sub_macros.get("fat"),
+                        "cooking_status": "pending",     # per-serving cooking
+                        "portioning_status": "pending",  # per-serving portioning
+                        "created_at": now,
+                    }
+                )
+
+        if serving_rows:
+            (
+                self.sb.table("meal_plan_day_recipe_serving")
+                .insert(serving_rows)
+                .execute()
+            )
 
         return day_to_meal_plan_day_id
 
@@ -489,16 +569,17 @@ class OrderService:
         partner_id,
         checkout_summary,
         day_to_meal_plan_day_id,
+        now,
     ):
         """
         Create one payment per meal day, linked to meal_plan_day.
-        Uses in-memory map instead of SELECT per day.
+        Uses in-memory map instead of SELECT per day; all rows go in one insert.
         """
         price_breakdown = checkout_summary.get("price_breakdown") or {}
         daily_breakdown = price_breakdown.get("daily_breakdown") or []
 
-        now = datetime.utcnow().isoformat()
-
+        # build every row first so a missing day fails before anything is written
+        payment_rows = []
         for day_data in daily_breakdown:
             date_str = day_data.get("date")
 
@@ -514,21 +595,19 @@ class OrderService:
             if not meal_plan_day_id:
                 raise ValueError(f"Missing meal_plan_day_id for date {date_str}")
 
-            (
-                self.sb.table("payment")
-                .insert(
-                    {
-                        "ordered_user_id": ordered_user_id,
-                        "partner_at_order": partner_id,
-                        "amount": amount,
-                        "status": "pending",
-                        "provider": None,
-                        "provider_payment_id": None,
-                        "currency": "USD",
-                        "meal_plan_day_id": meal_plan_day_id,
-                        "created_at": now,
-                    }
-                )
-                .execute()
+            payment_rows.append(
+                {
+                    "ordered_user_id": ordered_user_id,
+                    "partner_at_order": partner_id,
+                    "amount": amount,
+                    "status": "pending",
+                    "provider": None,
+                    "provider_payment_id": None,
+                    "currency": "USD",
+                    "meal_plan_day_id": meal_plan_day_id,
+                    "created_at": now,
+                }
             )
 
+        if payment_rows:
+            self.sb.table("payment").insert(payment_rows).execute()
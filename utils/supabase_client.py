@@ -1,5 +1,6 @@
 import os
-from supabase import create_client, Client
+import httpx
+from supabase import create_client, Client, ClientOptions
 
 # SUPABASE_URL = os.getenv("SUPABASE_URL")
 # SUPABASE_KEY = os.getenv("SUPABASE_KEY")
@@ -9,5 +10,21 @@ SUPABASE_KEY = 'eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpc3MiOiJzdXBhYmFzZSIsInJ
 
 
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# One pooled keep-alive HTTP client shared by every query, so repeated
+# .execute() calls reuse open connections instead of re-doing TLS handshakes
+_http_client = httpx.Client(
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(
+        max_keepalive_connections=20,
+        max_connections=50,
+        keepalive_expiry=60,
+    ),
+)
+
+supabase: Client = create_client(
+    SUPABASE_URL,
+    SUPABASE_KEY,
+    options=ClientOptions(httpx_client=_http_client),
+)
 